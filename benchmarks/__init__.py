@@ -0,0 +1 @@
+"""Benchmarks for `wbib` package."""
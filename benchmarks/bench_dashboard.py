@@ -0,0 +1,75 @@
+"""Benchmarks for rendering dashboards and resolving DOIs."""
+
+import functools
+import pytest
+from pathlib import Path
+from wbib import render, sparql, wbib
+from benchmarks.conftest import make_qids
+from tests.sparql_stub import KNOWN_DOIS, StubEndpoint
+
+
+@pytest.mark.parametrize("count", [10, 1000, 100000])
+def test_render_sections(benchmark, count, cold_cache):
+    qids = make_qids(count)
+    sections = benchmark.pedantic(
+        render.render_sections,
+        args=(wbib.DEFAULT_SESSIONS, wbib.DEFAULT_QUERY_OPTIONS, qids, "basic"),
+        setup=cold_cache,
+        rounds=5,
+    )
+    benchmark.extra_info["url_bytes"] = sum(
+        len(section["query"].encode("utf-8")) for section in sections
+    )
+
+
+@pytest.mark.parametrize("count", [10, 1000, 100000])
+def test_render_dashboard(benchmark, count, cold_cache, tmp_path):
+    qids = make_qids(count)
+    filepath = str(Path(tmp_path).joinpath("dashboard.html"))
+    benchmark.pedantic(
+        wbib.render_dashboard,
+        args=(qids,),
+        kwargs={"filepath": filepath, "return_html": False},
+        setup=cold_cache,
+        rounds=5,
+    )
+    benchmark.extra_info["html_bytes"] = Path(filepath).stat().st_size
+
+
+def test_render_materialized_dashboard(benchmark, cold_cache, tmp_path):
+    def answer(query):
+        bindings = [
+            {"item": {"type": "uri", "value": "http://www.wikidata.org/entity/" + qid}}
+            for qid in make_qids(100)
+        ]
+        return {"head": {"vars": ["item"]}, "results": {"bindings": bindings}}
+
+    filepath = str(Path(tmp_path).joinpath("dashboard.html"))
+    with StubEndpoint(answer) as endpoint:
+        executor = functools.partial(sparql.perform_query, endpoint=endpoint.url)
+        benchmark.pedantic(
+            wbib.render_dashboard,
+            args=(make_qids(1000),),
+            kwargs={
+                "filepath": filepath,
+                "materialize": True,
+                "executor": executor,
+                "return_html": False,
+            },
+            setup=cold_cache,
+            rounds=5,
+        )
+
+
+@pytest.mark.parametrize("count", [100, 10000])
+def test_convert_doi_to_qid(benchmark, count):
+    dois = list(KNOWN_DOIS) + ["10.1000/missing.{}".format(i) for i in range(count)]
+    with StubEndpoint() as endpoint:
+        result = benchmark.pedantic(
+            wbib.convert_doi_to_qid,
+            args=(dois,),
+            kwargs={"endpoint": endpoint.url},
+            rounds=5,
+        )
+    assert len(result["qids"]) == len(KNOWN_DOIS)
+    benchmark.extra_info["queries"] = len(endpoint.queries) // 5
@@ -0,0 +1,27 @@
+"""Benchmarks for importing the package in a fresh interpreter."""
+
+import subprocess
+import sys
+
+IMPORT_CODE = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "import wbib.wbib\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def _import_wbib():
+    return subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+
+
+def test_import_wbib(benchmark):
+    # The benchmark includes the interpreter startup; the import alone is reported
+    # as extra info.
+    output = benchmark.pedantic(_import_wbib, rounds=10)
+    benchmark.extra_info["import_seconds"] = float(output)
@@ -0,0 +1,42 @@
+"""Benchmarks for building selectors and query URLs."""
+
+import pytest
+import yaml
+from wbib import queries
+from benchmarks.conftest import make_qids
+
+BUILDERS = sorted(
+    name for name in dir(queries) if name.startswith("get_query_url_for_")
+)
+
+
+def test_format_with_prefix(benchmark, qids):
+    formatted = benchmark(queries.format_with_prefix, qids)
+    benchmark.extra_info["bytes"] = len(formatted)
+
+
+def test_get_selector(benchmark, qids, cold_cache):
+    selector = benchmark.pedantic(
+        queries.get_selector, args=(qids, "basic"), setup=cold_cache, rounds=5
+    )
+    benchmark.extra_info["bytes"] = len(selector)
+
+
+@pytest.mark.parametrize("name", BUILDERS)
+def test_query_url_builder(benchmark, name, cold_cache):
+    builder = getattr(queries, name)
+    qids = make_qids(1000)
+    url = benchmark.pedantic(builder, args=(qids,), setup=cold_cache, rounds=20)
+    # Tracked so that growing URLs show up when comparing runs.
+    benchmark.extra_info["url_bytes"] = len(url.encode("utf-8"))
+
+
+@pytest.mark.parametrize("name", BUILDERS)
+def test_query_url_builder_advanced(benchmark, name, cold_cache):
+    builder = getattr(queries, name)
+    with open("tests/config.yaml") as f:
+        info = yaml.safe_load(f)
+    url = benchmark.pedantic(
+        builder, args=(info, "advanced"), setup=cold_cache, rounds=20
+    )
+    benchmark.extra_info["url_bytes"] = len(url.encode("utf-8"))
@@ -0,0 +1,31 @@
+"""Shared fixtures for the benchmarks.
+
+The benchmarks need pytest-benchmark and are not collected by the test suite.
+Run them with `make benchmark`.
+"""
+
+import pytest
+from wbib import queries
+
+# Numbers of QIDs the query building benchmarks are run with.
+QID_COUNTS = [10, 1000, 100000, 1000000]
+
+
+def make_qids(count):
+    """Returns `count` distinct QIDs, in the range of real article items."""
+    return ["Q{}".format(50000000 + i * 7) for i in range(count)]
+
+
+@pytest.fixture(params=QID_COUNTS, ids=lambda count: "{}_qids".format(count))
+def qids(request):
+    return make_qids(request.param)
+
+
+@pytest.fixture
+def cold_cache():
+    """A `setup` for `benchmark.pedantic` that empties the query caches before each round."""
+
+    def setup():
+        queries.clear_query_cache()
+
+    return setup
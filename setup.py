@@ -10,7 +10,10 @@ with open("README.md") as readme_file:
 with open("HISTORY.md") as history_file:
     history = history_file.read()
 
-requirements = ["pandas", "wikidata2df", "Jinja2"]
+requirements = ["Jinja2", "PyYAML", "requests"]
+
+# Needed for the offline mode (wbib.offline) and the columnar exports (wbib.export).
+extras_requirements = {"offline": ["pyoxigraph>=0.4"], "export": ["pyarrow"]}
 
 setup_requirements = []
 
@@ -19,20 +22,19 @@ test_requirements = []
 setup(
     author="Tiago Lubiana",
     author_email="tiago.lubiana.alves@usp.br",
-    python_requires=">=3.5",
+    python_requires=">=3.7",
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Natural Language :: English",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
     ],
     description="A helper for building Wikidata-based literature dashboards via SPARQL queries. ",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + "\n\n" + history,
     long_description_content_type="text/markdown",
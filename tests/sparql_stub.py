@@ -0,0 +1,137 @@
+"""A local stand-in for a SPARQL endpoint, used by the tests."""
+
+import json
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# DOI (as stored on Wikidata, upper case) -> QID
+KNOWN_DOIS = {
+    "10.3897/RIO.2.E9342": "Q61654697",
+    "10.3389/FIMMU.2019.02736": "Q92072015",
+    "10.1002/(SICI)1097-4636(199706)35:4<447::AID-JBM5>3.0.CO;2-D": "Q28303526",
+}
+
+# Property -> identifier (as stored on Wikidata) -> QID
+KNOWN_IDENTIFIERS = {
+    "P356": KNOWN_DOIS,
+    "P698": {"31361758": "Q64977913"},
+    "P932": {"6873413": "Q64977913"},
+    "P818": {"1706.03762": "Q30249683"},
+    "P496": {"0000-0003-2473-2313": "Q42614737"},
+}
+
+
+def answer_doi_query(query):
+    """Answers the lookup queries built by wbib.identifiers.build_lookup_query"""
+    values = re.search(r"VALUES \?id \{(.*?)\}", query, re.S).group(1)
+    known = KNOWN_IDENTIFIERS[re.search(r"wdt:(P\d+) \?id", query).group(1)]
+    bindings = []
+    for value in re.findall(r'"([^"]*)"', values):
+        qid = known.get(value)
+        if qid is not None:
+            bindings.append(
+                {
+                    "id": {"type": "literal", "value": value},
+                    "item": {
+                        "type": "uri",
+                        "value": "http://www.wikidata.org/entity/" + qid,
+                    },
+                }
+            )
+    return {"head": {"vars": ["id", "item"]}, "results": {"bindings": bindings}}
+
+
+def to_tsv(result):
+    """Writes SPARQL JSON results as SPARQL TSV results"""
+    variables = result["head"]["vars"]
+    lines = ["\t".join("?" + name for name in variables)]
+    for binding in result["results"]["bindings"]:
+        fields = []
+        for name in variables:
+            term = binding.get(name)
+            if term is None:
+                fields.append("")
+            elif term["type"] == "uri":
+                fields.append("<" + term["value"] + ">")
+            else:
+                value = term["value"].replace("\\", "\\\\").replace('"', '\\"')
+                value = value.replace("\t", "\\t").replace("\n", "\\n")
+                fields.append('"' + value + '"')
+        lines.append("\t".join(fields))
+    return "\n".join(lines) + "\n"
+
+
+class StubEndpoint:
+    """
+    Serves SPARQL JSON results on localhost from a callable that maps a query
+    string to a result dict.
+
+    Use it as a context manager; `url` holds the address of the endpoint and
+    `queries` records every query received. The first requests can be answered
+    with errors by passing `errors`, a list of (status, headers) pairs.
+    Requests that prefer TSV are answered with TSV, unless `tsv` is False.
+    Answers given as strings are served as Turtle, for CONSTRUCT queries.
+    """
+
+    def __init__(self, answer=answer_doi_query, errors=(), tsv=True):
+        self.answer = answer
+        self.errors = list(errors)
+        self.tsv = tsv
+        self.formats = []
+        self.queries = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+                self._respond(form["query"][0])
+
+            def do_GET(self):
+                form = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                self._respond(form["query"][0])
+
+            def _respond(self, query):
+                if stub.errors:
+                    status, headers = stub.errors.pop(0)
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                stub.queries.append(query)
+                accept = self.headers.get("Accept", "")
+                result = stub.answer(query)
+                if isinstance(result, str):
+                    content_type = "text/turtle; charset=utf-8"
+                    body = result.encode("utf-8")
+                elif stub.tsv and accept.startswith("text/tab-separated-values"):
+                    content_type = "text/tab-separated-values; charset=utf-8"
+                    body = to_tsv(result).encode("utf-8")
+                else:
+                    content_type = "application/sparql-results+json"
+                    body = json.dumps(result).encode("utf-8")
+                stub.formats.append(content_type.split(";")[0])
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/sparql".format(self.server.server_port)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
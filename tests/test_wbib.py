@@ -1,20 +1,208 @@
 #!/usr/bin/env python
 
 """Tests for `wbib` package."""
+import asyncio
+import bz2
+import functools
+import gzip
+import importlib.util
+import io
+import json
+import re
+import subprocess
+import sys
+import tempfile
 import unittest
-from wbib import wbib, queries
+import urllib.parse
+from pathlib import Path
+from unittest import mock
+from wbib import wbib, changes, dois, export, identifiers, index, instrumentation, jobs
+from wbib import offline, queries, render
+from wbib import sparql
+from wbib.cache import SPARQLCache
+from wbib.qids import QIDSet
+from tests.sparql_stub import StubEndpoint
 import yaml
 
 
 class TestWbib(unittest.TestCase):
     """Tests for `wbib` package."""
 
+    def test_lazy_imports(self):
+        # The import time itself is measured in benchmarks/bench_import.py.
+        code = (
+            "import sys\n"
+            "import wbib.wbib\n"
+            "heavy = ['pandas', 'wikidata2df', 'jinja2', 'requests', 'asyncio', 'yaml']\n"
+            "print(' '.join(m for m in heavy if m in sys.modules))\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout
+
+        assert output.strip() == ""
+
     def test_format_with_prefix(self):
         qids = ["Q35185544", "Q34555562", "Q21284234"]
         result = "{ wd:Q35185544 wd:Q34555562 wd:Q21284234 }"
         test = queries.format_with_prefix(qids)
         assert result == test
 
+    def test_qid_set(self):
+        qids = QIDSet(["Q35185544", "Q34555562", "Q21284234", "Q34555562"])
+        assert list(qids) == ["Q21284234", "Q34555562", "Q35185544"]
+        assert "Q34555562" in qids and "Q1" not in qids
+        assert queries.format_with_prefix(qids) == queries.format_with_prefix(
+            list(qids)
+        )
+        assert [list(part) for part in qids.split(2)] == [
+            ["Q21284234", "Q34555562"],
+            ["Q35185544"],
+        ]
+        assert queries.get_selector(qids, "basic") == queries.get_selector(
+            list(qids), "basic"
+        )
+        with self.assertRaises(ValueError):
+            QIDSet(["P31"])
+
+    def test_optimized_selector(self):
+        def answer(query):
+            items = ["Q12174", "Q999"] if "P279" in query else ["Q12585", "Q155"]
+            bindings = [
+                {"item": {"type": "uri", "value": "http://www.wikidata.org/entity/" + q}}
+                for q in items
+            ]
+            return {"head": {"vars": ["item"]}, "results": {"bindings": bindings}}
+
+        queries.clear_query_cache()
+        with open("tests/config.yaml") as f2:
+            config = yaml.load(f2, Loader=yaml.FullLoader)
+        with StubEndpoint(answer) as endpoint:
+            executor = functools.partial(sparql.perform_query, endpoint=endpoint.url)
+            optimized = queries.optimize_restrictions(config, executor)
+            queries.optimize_restrictions(config, executor)
+        assert len(endpoint.queries) == 2
+
+        selector = queries.get_selector(optimized)
+        assert "wdt:P279*" not in selector and "?country wdt:P361*" not in selector
+        assert "wd:Q999" in selector and "wd:Q155" in selector
+        assert selector.index("?topics") < selector.index("?gender")
+        assert selector.index("hint:Prior hint:runFirst") < selector.index("?gender")
+        assert "%selection" in queries.get_selection_subquery(optimized)
+
+    def test_shared_selection(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        for option in wbib.DEFAULT_QUERY_OPTIONS.values():
+            query = queries.query_from_url(option["query"](qids, "basic"))
+            assert query.count("VALUES ?work") == 1
+            assert "INCLUDE %selection" in query
+
+    def test_advanced_selection(self):
+        with open("tests/config.yaml") as f2:
+            config = yaml.load(f2, Loader=yaml.FullLoader)
+        locations = queries.query_from_url(
+            queries.get_query_url_for_locations(config, "advanced")
+        )
+        selection = dict(queries._split_query(locations)[1])["selection"]
+        # The map joins on the organizations of the region, as when the selector
+        # was written in each query.
+        assert re.search(r"SELECT \* WHERE", selection)
+        assert "?organization wdt:P17 ?country" in selection
+        if importlib.util.find_spec("pyoxigraph") is None:
+            return
+
+        # An author with one affiliation in Latin America and one in Germany.
+        data = """
+            @prefix wd: <http://www.wikidata.org/entity/> .
+            @prefix wdt: <http://www.wikidata.org/prop/direct/> .
+            wd:Q1 wdt:P50 wd:Q10 ; wdt:P921 wd:Q12174 .
+            wd:Q10 wdt:P21 wd:Q6581072 ; wdt:P108 wd:Q20, wd:Q30 .
+            wd:Q20 wdt:P17 wd:Q155 ; wdt:P625 "Point(-47 -15)" .
+            wd:Q30 wdt:P17 wd:Q183 ; wdt:P625 "Point(13 52)" .
+            wd:Q155 wdt:P361 wd:Q12585 .
+        """
+        source = offline.LocalStore()
+        source.load(data.encode())
+        [organization] = source.query(
+            offline.translate_query(locations, use_stored_selection=False),
+            translate=False,
+        )["results"]["bindings"]
+        assert organization["organization"]["value"].endswith("/Q20")
+
+        # The copy of the selection used offline keeps the organizations too.
+        from pyoxigraph import RdfFormat
+
+        prefixes = "".join(
+            "PREFIX {}: <{}>\n".format(prefix, iri)
+            for prefix, iri in offline.PREFIXES.items()
+        )
+        store = offline.LocalStore()
+        for construct in offline.subgraph_queries(config, "advanced"):
+            triples = source._store.query(prefixes + construct)
+            triples = triples.serialize(format=RdfFormat.N_TRIPLES)
+            store.load(triples, "application/n-triples")
+        [organization] = store(locations)["results"]["bindings"]
+        assert organization["organization"]["value"].endswith("/Q20")
+
+    def test_combined_sections(self):
+        def answer(query):
+            bindings = [
+                {
+                    "section": {"type": "literal", "value": name},
+                    "count": {"type": "literal", "value": name},
+                }
+                for name in re.findall(r'\("(\w+)" AS \?section\)', query)
+            ]
+            return {
+                "head": {"vars": ["section", "count"]},
+                "results": {"bindings": bindings},
+            }
+
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp, StubEndpoint(answer) as endpoint:
+            html = wbib.render_dashboard(
+                qids,
+                filepath=str(Path(tmp).joinpath("x.html")),
+                materialize=True,
+                executor=functools.partial(sparql.perform_query, endpoint=endpoint.url),
+                combine_sections=True,
+            )
+
+        assert len(endpoint.queries) == 1
+        combined = endpoint.queries[0]
+        assert combined.count("VALUES ?work") == 1
+        assert combined.count("AS %selection") == 1
+        assert "%authors_and_number_of_works_6" in combined
+        # Only the sections that project ?count show the value
+        for count in [2, 3, 4, 5]:
+            assert "<td>{}</td>".format(count) in html
+        assert "<td>0</td>" not in html
+
+    def test_query_memoization(self):
+        queries.clear_query_cache()
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        first = queries.get_query_url_for_authors(qids)
+        again = queries.get_query_url_for_authors(list(reversed(qids)) + qids)
+        queries.get_query_url_for_topic_bubble(qids)
+
+        assert first == again
+        assert queries.get_query_url_for_authors.__name__ == "get_query_url_for_authors"
+        assert queries._get_cached_selector.cache_info().misses == 1
+
+        queries.clear_query_cache()
+        assert queries._get_cached_selector.cache_info().currsize == 0
+
+        # Rendering a dashboard leaves no URL of it in memory.
+        with tempfile.TemporaryDirectory() as tmp:
+            wbib.render_dashboard(qids, filepath=str(Path(tmp).joinpath("x.html")))
+        assert queries._get_cached_selector.cache_info().currsize == 0
+        assert all(
+            builder.cache_info().currsize == 0 for builder in queries._cached_builders
+        )
+
     def test_doi_to_qid(self):
         dois = ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736", "wrong"]
         result = {"missing": set(["wrong"]), "qids": set(["Q61654697", "Q92072015"])}
@@ -22,6 +210,287 @@ class TestWbib(unittest.TestCase):
         assert result["missing"] == test["missing"]
         assert result["qids"] == test["qids"]
 
+    def test_doi_to_qid_in_chunks(self):
+        dois = ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736", "wrong"] + [
+            "10.1000/missing.{}".format(i) for i in range(20)
+        ]
+        with StubEndpoint() as endpoint:
+            test = wbib.convert_doi_to_qid(
+                dois + dois, chunk_size=4, max_workers=2, endpoint=endpoint.url
+            )
+        assert len(endpoint.queries) == 6
+        assert test["qids"] == set(["Q61654697", "Q92072015"])
+        assert test["missing"] == set(dois[2:])
+
+    def test_doi_to_qid_with_cache(self):
+        dois = ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736", "wrong"]
+        with SPARQLCache(":memory:") as cache, StubEndpoint() as endpoint:
+            first = wbib.convert_doi_to_qid(dois, endpoint=endpoint.url, cache=cache)
+            second = wbib.convert_doi_to_qid(dois, endpoint=endpoint.url, cache=cache)
+            assert (cache.hits, cache.misses) == (1, 1)
+        assert len(endpoint.queries) == 1
+        assert first == second
+
+    def test_sici_doi(self):
+        sici = "10.1002/(sici)1097-4636(199706)35:4<447::aid-jbm5>3.0.co;2-d"
+        with StubEndpoint() as endpoint:
+            test = wbib.convert_doi_to_qid(
+                ["doi:" + sici, "wrong"], endpoint=endpoint.url
+            )
+        assert test == {"qids": {"Q28303526"}, "missing": {"wrong"}}
+
+        entity = {
+            "id": "Q28303526",
+            "claims": {
+                "P356": [
+                    {
+                        "mainsnak": {
+                            "snaktype": "value",
+                            "datavalue": {"value": sici.upper()},
+                        },
+                        "rank": "normal",
+                    }
+                ]
+            },
+        }
+        line = json.dumps(entity).encode() + b",\n"
+        assert index._extract_identifiers([line], ["P356"]) == [
+            (b"doi:" + sici.upper().encode(), 28303526)
+        ]
+        # DOI fields of reference-manager exports are explicit DOIs too.
+        assert list(dois.read_dois(["DO  - " + sici], "ris")) == [sici.upper()]
+
+    def test_streamed_doi_to_qid(self):
+        dois = ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736", "wrong"]
+        for tsv in (True, False):
+            with StubEndpoint(tsv=tsv) as endpoint:
+                pairs = wbib.iter_doi_qids(dois, chunk_size=2, endpoint=endpoint.url)
+                pairs = set(pairs)
+            assert pairs == {
+                ("10.3897/RIO.2.E9342", "Q61654697"),
+                ("10.3389/fimmu.2019.02736", "Q92072015"),
+            }
+            expected_format = "text/tab-separated-values" if tsv else "application/"
+            assert all(f.startswith(expected_format) for f in endpoint.formats)
+
+        # Streaming never loads pandas; checked in a fresh interpreter, as other tests
+        # may have imported it already.
+        code = (
+            "import sys\n"
+            "from wbib import wbib\n"
+            "from tests.sparql_stub import StubEndpoint\n"
+            "with StubEndpoint() as endpoint:\n"
+            "    list(wbib.iter_doi_qids(sys.argv[1:], endpoint=endpoint.url))\n"
+            "print('pandas' in sys.modules)\n"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code] + dois,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout
+        assert output.strip() == "False"
+
+    def test_read_dois(self):
+        bibtex = (
+            "@article{a,\n  title = {A},\n  doi = {10.3897/rio.2.e9342},\n}\n"
+            '@article{b,\n  DOI = "https://doi.org/10.1000/x\\_y",\n}\n'
+        )
+        ris = "TY  - JOUR\nDO  - 10.3389/fimmu.2019.02736\nUR  - https://x.org\n"
+        csv_text = "title,doi\nA,doi:10.3897/RIO.2.E9342\nB,\nC,not a doi\n"
+        with tempfile.TemporaryDirectory() as tmp:
+            with gzip.open(Path(tmp).joinpath("refs.bib.gz"), "wt") as f:
+                f.write(bibtex)
+            Path(tmp).joinpath("refs.ris").write_text(ris)
+            Path(tmp).joinpath("refs.csv").write_text(csv_text)
+            read = {
+                name: list(dois.read_dois(str(Path(tmp).joinpath(name))))
+                for name in ["refs.bib.gz", "refs.ris", "refs.csv"]
+            }
+        assert read == {
+            "refs.bib.gz": ["10.3897/RIO.2.E9342", "10.1000/X_Y"],
+            "refs.ris": ["10.3389/FIMMU.2019.02736"],
+            "refs.csv": ["10.3897/RIO.2.E9342"],
+        }
+        deduplicated = dois.deduplicate(["A", "B", "A", "C", "B", "A"], window=2)
+        assert list(deduplicated) == ["A", "B", "C", "B", "A"]
+
+    def test_doi_stream(self):
+        lines = ["10.3897/RIO.2.E9342", "https://doi.org/10.3389/fimmu.2019.02736"]
+        lines += ["10.1000/missing.{}".format(i) for i in range(10)] + lines
+        qids_out, missing_out = io.StringIO(), io.StringIO()
+        with StubEndpoint() as endpoint:
+            counts = wbib.convert_doi_stream(
+                iter(lines),
+                qids_out,
+                missing_out,
+                chunk_size=3,
+                max_workers=2,
+                endpoint=endpoint.url,
+            )
+        assert counts == {"dois": 12, "found": 2, "missing": 10}
+        assert len(endpoint.queries) == 4
+        assert qids_out.getvalue().splitlines() == [
+            "10.3897/RIO.2.E9342\tQ61654697",
+            "10.3389/FIMMU.2019.02736\tQ92072015",
+        ]
+        assert len(missing_out.getvalue().splitlines()) == 10
+
+    def test_resumable_doi_job(self):
+        lines = ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736"]
+        lines += ["10.1000/missing.{}".format(i) for i in range(7)] + lines
+        reports = []
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = str(Path(tmp).joinpath("job.sqlite"))
+            with StubEndpoint(errors=[(500, {})]) as endpoint:
+                with sparql.AsyncSPARQLClient(endpoint.url, max_concurrency=1) as client:
+                    with jobs.DOIResolutionJob(checkpoint, 3, client=client) as job:
+                        assert job.plan(lines) == 9
+                        status = job.run(progress=reports.append)
+                        assert (status["done"], status["failed"]) == (2, 1)
+                        assert list(job.errors()) == [0]
+                        assert len(job.results()["missing"]) == 6
+
+                    # Resuming from the checkpoint only runs the failed chunk
+                    with jobs.DOIResolutionJob(checkpoint, client=client) as job:
+                        assert job.plan(["10.1000/other"]) == 9
+                        assert job.run()["done"] == 3
+                        results = job.results()
+            assert len(endpoint.queries) == 3
+        assert results["qids"] == {"Q61654697", "Q92072015"}
+        assert len(results["missing"]) == 7
+        assert [report["done"] for report in reports] == [0, 1, 2]
+        assert reports[-1]["eta"] == 0
+
+    def test_tsv_parsing(self):
+        lines = [
+            "?item\t?title\t?count",
+            '<http://www.wikidata.org/entity/Q1>\t"a \\"b\\"\\tc"@en\t3',
+            '<http://www.wikidata.org/entity/Q2>\t\t"4"^^<http://x/int>',
+        ]
+        rows = list(sparql.iter_tsv_rows(lines))
+        assert rows == [
+            {
+                "item": "http://www.wikidata.org/entity/Q1",
+                "title": 'a "b"\tc',
+                "count": "3",
+            },
+            {"item": "http://www.wikidata.org/entity/Q2", "title": None, "count": "4"},
+        ]
+        chunks = [b"?a\n<x>\n", b'"caf\xc3', b'\xa9"\r\n"\xe2\x80\xa8"']
+        rows = list(sparql.iter_tsv_rows(sparql._iter_lines(chunks)))
+        assert rows == [{"a": "x"}, {"a": "café"}, {"a": "\u2028"}]
+
+    def test_resolve_identifiers(self):
+        mixed = [
+            "https://doi.org/10.3897/rio.2.e9342",
+            "PMID: 31361758",
+            "PMC6873413",
+            "arXiv:1706.03762v5",
+            "https://orcid.org/0000-0003-2473-2313",
+            ("pmid", "1"),
+            "not an identifier",
+        ]
+        with StubEndpoint() as endpoint:
+            test = wbib.resolve_identifiers(mixed, endpoint=endpoint.url)
+        assert len(endpoint.queries) == 5
+        assert test["qids"] == {
+            "https://doi.org/10.3897/rio.2.e9342": {"Q61654697"},
+            "PMID: 31361758": {"Q64977913"},
+            "PMC6873413": {"Q64977913"},
+            "arXiv:1706.03762v5": {"Q30249683"},
+            "https://orcid.org/0000-0003-2473-2313": {"Q42614737"},
+        }
+        assert test["missing"] == {"1"}
+        assert test["unrecognized"] == {"not an identifier"}
+        assert identifiers.detect_identifier("0000000324732313") == (
+            "orcid",
+            "0000-0003-2473-2313",
+        )
+
+    def test_dump_index(self):
+        dump = Path("tests/wikidata_dump.json").read_bytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            dump_path = str(Path(tmp).joinpath("dump.json.bz2"))
+            with bz2.open(dump_path, "wb") as f:
+                f.write(dump)
+            index_path = str(Path(tmp).joinpath("identifiers.idx"))
+            count = index.build_index(
+                dump_path, index_path, kinds=["doi", "pmid", "arxiv"], processes=2
+            )
+            assert count == 5
+
+            mixed = ["10.3389/fimmu.2019.02736", "PMID:31361758", "0000-0003-2473-2313"]
+            with index.IdentifierIndex(index_path) as dump_index:
+                assert dump_index.kinds == {"doi", "pmid", "arxiv"}
+                # Deprecated and non-preferred statements are left out, as in wdt:.
+                assert dump_index.lookup("10.3389/OLD.2019.02736") == []
+                assert dump_index.lookup("10.1000/DEPRECATED") == []
+                assert dump_index.lookup("1706.03762", "arxiv") == ["Q64977913"]
+                test = wbib.convert_doi_to_qid(
+                    ["10.3897/rio.2.e9342", "10.1000/missing"], index=dump_index
+                )
+                # ORCIDs are not in the index, so they are still looked up online.
+                with StubEndpoint() as endpoint:
+                    resolved = wbib.resolve_identifiers(
+                        mixed, endpoint=endpoint.url, index=dump_index
+                    )
+
+        assert test == {"qids": {"Q27"}, "missing": {"10.1000/missing"}}
+        assert len(endpoint.queries) == 1
+        assert resolved["qids"] == {
+            "10.3389/fimmu.2019.02736": {"Q30249683", "Q64977913"},
+            "PMID:31361758": {"Q27"},
+            "0000-0003-2473-2313": {"Q42614737"},
+        }
+
+    def test_dump_index_runs(self):
+        # Items sharing a DOI, spread over several sorted runs, some more than once.
+        entity = (
+            '{"type":"item","id":"Q%d","claims":{"P356":[{"mainsnak":'
+            '{"snaktype":"value","property":"P356","datavalue":'
+            '{"value":"10.1000/SHARED","type":"string"}},"rank":"normal"}]}},\n'
+        )
+        lines = [entity % number for number in [9, 10, 10, 100, 9, 1000]]
+        with tempfile.TemporaryDirectory() as tmp:
+            dump_path = Path(tmp).joinpath("dump.json")
+            dump_path.write_text("[\n" + "".join(lines) + "]\n")
+            index_path = str(Path(tmp).joinpath("identifiers.idx"))
+            with mock.patch.multiple(index, LINES_PER_TASK=2, RUN_SIZE=2):
+                count = index.build_index(str(dump_path), index_path, processes=1)
+            with index.IdentifierIndex(index_path) as dump_index:
+                qids = dump_index.lookup("10.1000/SHARED")
+
+        assert count == 4
+        assert qids == ["Q10", "Q100", "Q1000", "Q9"]
+
+    def test_async_client_retries(self):
+        dois = ["10.3897/RIO.2.E9342", "wrong"]
+        errors = [(429, {"Retry-After": "0"}), (503, {})]
+        with StubEndpoint(errors=errors) as endpoint:
+            with sparql.AsyncSPARQLClient(
+                endpoint.url, max_concurrency=2, rate=100, backoff=0.01
+            ) as client:
+                test = wbib.convert_doi_to_qid(dois, client=client)
+                results = asyncio.run(
+                    client.query_many([identifiers.build_lookup_query(dois, "doi")] * 3)
+                )
+
+        assert test == {"qids": set(["Q61654697"]), "missing": set(["wrong"])}
+        assert [t["status"] for t in client.timings[:3]] == [429, 503, 200]
+        assert len(client.timings) == 6
+        assert len(results) == 3 and results[0] == results[2]
+
+    def test_cache_expiry_and_eviction(self):
+        with SPARQLCache(":memory:", ttl=60, max_entries=2) as cache:
+            cache.set("SELECT  ?a\n WHERE {}", "e", {"n": 1})
+            assert cache.get("SELECT ?a WHERE {}", "e") == {"n": 1}
+            cache.set("SELECT ?b WHERE {}", "e", {"n": 2})
+            cache.set("SELECT ?c WHERE {}", "e", {"n": 3})
+            assert len(cache) == 2
+            cache.ttl = -1
+            assert cache.get("SELECT ?c WHERE {}", "e") is None
+
     def test_advanced_rendering(self):
         with open("tests/config.yaml") as f2:
             config = yaml.load(f2, Loader=yaml.FullLoader)
@@ -40,6 +509,405 @@ class TestWbib(unittest.TestCase):
         )
         assert "Demonstration" in html
 
+    def test_render_dashboards(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp:
+            bad_config = Path(tmp).joinpath("bad.yaml")
+            bad_config.write_text("title: [unclosed")
+            configs = [
+                {"info": qids, "filepath": str(Path(tmp).joinpath("basic.html"))},
+                str(bad_config),
+                {
+                    "info": qids,
+                    "site_title": "Second",
+                    "filepath": str(Path(tmp).joinpath("second.html")),
+                },
+            ]
+            results = wbib.render_dashboards(configs, workers=2)
+
+            assert [r["error"] is None for r in results] == [True, False, True]
+            assert results[0]["path"].read_text().count("<iframe") == 7
+            assert "Second" in results[2]["path"].read_text()
+            assert all(r["seconds"] >= 0 for r in results)
+
+    def test_incremental_rendering(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {"info": qids, "filepath": str(Path(tmp).joinpath("basic.html"))}
+            other = {"info": qids, "filepath": str(Path(tmp).joinpath("other.html"))}
+
+            first = wbib.render_dashboards([config, other], incremental=True)
+            second = wbib.render_dashboards(
+                [config, dict(other, info=qids[:2])], incremental=True
+            )
+            html = wbib.render_dashboard(incremental=True, **config)
+
+            assert [r["written"] for r in first] == [True, True]
+            assert [r["written"] for r in second] == [False, True]
+            assert "wd:Q21284234" in urllib.parse.unquote(html)
+
+    def test_sharded_rendering(self):
+        qids = ["Q{}".format(i) for i in range(1, 2001)]
+        sections = render.render_sections(
+            ["list of authors"],
+            wbib.DEFAULT_QUERY_OPTIONS,
+            qids,
+            "basic",
+            max_url_bytes=8000,
+        )
+        shards = sections[0]["shards"]
+
+        assert len(shards) > 1
+        assert all(len(url) <= 8000 for url in shards)
+        assert sum(urllib.parse.unquote(url).count("wd:Q") for url in shards) == 2000
+
+        with tempfile.TemporaryDirectory() as tmp:
+            html = wbib.render_dashboard(
+                qids, filepath=str(Path(tmp).joinpath("x.html")), max_url_bytes=8000
+            )
+        assert "part 1 of" in html
+
+        for qids in ([], ["Q1"]):
+            urls = render.shard_query_urls(
+                queries.get_query_url_for_authors, qids, "basic", max_url_bytes=10
+            )
+            assert len(urls) == 1
+
+    def test_lazy_split_rendering(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp:
+            html = wbib.render_dashboard(
+                qids,
+                filepath=str(Path(tmp).joinpath("x.html")),
+                pages=wbib.EXAMPLE_PAGES,
+                lazy_load=True,
+                split_pages=True,
+            )
+            written = sorted(path.name for path in Path(tmp).iterdir())
+            authors = Path(tmp).joinpath("x_list_of_authors.html").read_text()
+
+        assert len(written) == len(wbib.DEFAULT_SESSIONS)
+        assert "x_list_of_venues.html" in written
+        assert html.count("<iframe") == 1
+        assert ' src="https://query.wikidata.org' not in html
+        assert 'data-src="https://query.wikidata.org' in html
+        assert "IntersectionObserver" in html
+        assert 'href="/"' in html and 'href="x_list_of_authors.html"' in html
+        assert 'nav-link active" href="x_list_of_authors.html"' in authors
+        assert '<h5 class="title is-5">list of authors' in authors
+        assert '<h5 class="title is-5">list of venues' not in authors
+
+    def test_materialized_rendering(self):
+        def answer(query):
+            return {
+                "head": {"vars": ["author", "count"]},
+                "results": {
+                    "bindings": [
+                        {
+                            "author": {
+                                "type": "uri",
+                                "value": "http://www.wikidata.org/entity/Q42",
+                            },
+                            "count": {"type": "literal", "value": "<3>"},
+                        }
+                    ]
+                },
+            }
+
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp, StubEndpoint(answer) as endpoint:
+            html = wbib.render_dashboard(
+                qids,
+                filepath=str(Path(tmp).joinpath("x.html")),
+                materialize=True,
+                executor=lambda query: sparql.perform_query(query, endpoint.url),
+            )
+
+        assert len(endpoint.queries) == len(wbib.DEFAULT_SESSIONS)
+        assert "<iframe" not in html
+        assert html.count(">Q42</a>") == len(wbib.DEFAULT_SESSIONS)
+        assert "&lt;3&gt;" in html
+
+    @unittest.skipUnless(importlib.util.find_spec("pyoxigraph"), "needs pyoxigraph")
+    def test_offline_rendering(self):
+        subgraph = Path("tests/subgraph.ttl").read_text()
+        qids = ["Q1", "Q2"]
+        store = offline.LocalStore()
+        with StubEndpoint(lambda query: subgraph) as endpoint:
+            client = sparql.AsyncSPARQLClient(endpoint=endpoint.url)
+            with client:
+                store.fetch(qids, client=client)
+        assert len(endpoint.queries) == len(offline.subgraph_queries(qids))
+        assert all(query.startswith("CONSTRUCT") for query in endpoint.queries)
+
+        translated = offline.translate_query(
+            queries.query_from_url(queries.get_query_url_for_locations(qids))
+        )
+        assert "WITH" not in translated and "SERVICE" not in translated
+        assert "GROUP BY ?organization ?geo\n" in translated
+
+        # Every section builder runs locally.
+        for name in dir(queries):
+            if name.startswith("get_query_url_for_"):
+                store(queries.query_from_url(getattr(queries, name)(qids)))
+
+        authors = store(queries.query_from_url(queries.get_query_url_for_authors(qids)))
+        [author] = authors["results"]["bindings"]
+        assert author["authorLabel"]["value"] == "Ada Author"
+        assert author["count"]["value"] == "2"
+        articles = queries.get_query_url_for_articles(qids)
+        assert len(store(queries.query_from_url(articles))["results"]["bindings"]) == 2
+        # The works of a shard are kept apart from the rest of the stored selection.
+        shard = queries.get_query_url_for_articles(["Q1"])
+        [article] = store(queries.query_from_url(shard))["results"]["bindings"]
+        assert article["venueLabel"]["value"] == "Journal of Tests"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            html = wbib.render_dashboard(
+                qids,
+                filepath=str(Path(tmp).joinpath("x.html")),
+                materialize=True,
+                executor=store,
+                combine_sections=True,
+            )
+        assert "<iframe" not in html
+        assert "Ada Author" in html and "Institute" in html
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "needs pyarrow")
+    def test_columnar_export(self):
+        result = {
+            "head": {"vars": ["author", "count", "date", "female", "authorLabel"]},
+            "results": {
+                "bindings": [
+                    {
+                        "author": {
+                            "type": "uri",
+                            "value": "http://www.wikidata.org/entity/Q42",
+                        },
+                        "count": {
+                            "type": "literal",
+                            "value": "3",
+                            "datatype": "http://www.w3.org/2001/XMLSchema#integer",
+                        },
+                        "date": {
+                            "type": "literal",
+                            "value": "2019-05-01T00:00:00Z",
+                            "datatype": "http://www.w3.org/2001/XMLSchema#dateTime",
+                        },
+                        "female": {
+                            "type": "literal",
+                            "value": "false",
+                            "datatype": "http://www.w3.org/2001/XMLSchema#boolean",
+                        },
+                    },
+                    {"authorLabel": {"type": "literal", "value": "Douglas"}},
+                ]
+            },
+        }
+        # pyarrow imports pandas, which the other tests check is never needed, so the
+        # export runs in its own interpreter.
+        code = (
+            "import json, sys\n"
+            "from wbib import export, wbib\n"
+            "calls = []\n"
+            "def answer(query):\n"
+            "    calls.append(query)\n"
+            "    return json.loads(sys.argv[1])\n"
+            "wbib.render_dashboard(\n"
+            "    ['Q35185544', 'Q34555562', 'Q21284234'],\n"
+            "    sections_to_add=['list of authors', 'list of topics'],\n"
+            "    filepath=sys.argv[2] + '/x.html',\n"
+            "    materialize=True,\n"
+            "    executor=answer,\n"
+            "    export_directory=sys.argv[2],\n"
+            ")\n"
+            "table = export.read_table(sys.argv[2] + '/list_of_authors.arrow')\n"
+            "authors = table.column('author').to_pylist()\n"
+            "date = str(table.column('date')[0])\n"
+            "female = table.column('female').to_pylist()\n"
+            "print(json.dumps([len(calls), authors, date, female]))\n"
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            output = subprocess.run(
+                [sys.executable, "-c", code, json.dumps(result), tmp],
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                check=True,
+            ).stdout
+            manifest = json.loads(Path(tmp).joinpath(export.MANIFEST_NAME).read_text())
+
+        calls, authors, date, female = json.loads(output)
+        # The materialized results are exported without running the queries again.
+        assert calls == 2
+        assert authors == [42, None]
+        assert date == "2019-05-01"
+        assert female == [False, None]
+        assert [section["file"] for section in manifest["sections"]] == [
+            "list_of_authors.arrow",
+            "list_of_co_studied_topics.arrow",
+        ]
+        assert manifest["sections"][0]["rows"] == 2
+        assert manifest["sections"][0]["columns"] == [
+            {"name": "author", "type": "qid"},
+            {"name": "count", "type": "int64"},
+            {"name": "date", "type": "date32[day]"},
+            {"name": "female", "type": "bool"},
+            {"name": "authorLabel", "type": "string"},
+        ]
+
+    def test_change_tracking(self):
+        authors = {"Q1": "Q10", "Q2": "Q20", "Q3": "Q30"}
+        entities = list(authors) + list(authors.values())
+        modified = dict.fromkeys(entities, "2025-01-01T00:00:00Z")
+        section_queries = []
+        entity_prefix = "http://www.wikidata.org/entity/"
+
+        def answer(query):
+            if "schema:dateModified" not in query:
+                section_queries.append(query)
+                return {"head": {"vars": ["x"]}, "results": {"bindings": []}}
+            bindings = []
+            for work in re.findall(r"wd:(Q\d+)", query):
+                for role, entity in [("work", work), ("author", authors[work])]:
+                    bindings.append(
+                        {
+                            "entity": {"type": "uri", "value": entity_prefix + entity},
+                            "role": {"type": "literal", "value": role},
+                            "modified": {"type": "literal", "value": modified[entity]},
+                        }
+                    )
+            variables = ["entity", "role", "modified"]
+            return {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+        feed = changes.read_changes("tests/recentchanges.jsonl")
+        assert feed == {"Q10", "Q99"}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            configs = [
+                {
+                    "info": [work],
+                    "filepath": str(Path(tmp).joinpath(work + ".html")),
+                    "materialize": True,
+                }
+                for work in ["Q1", "Q2"]
+            ]
+            with changes.ChangeTracker(":memory:") as tracker:
+                with SPARQLCache(":memory:") as cache:
+                    first = tracker.refresh(configs, executor=answer, cache=cache)
+                    built = len(section_queries)
+                    # Only the author of the first dashboard was edited, including
+                    # its label, which the curation of author items shows.
+                    second = tracker.refresh(
+                        configs, changes=feed, executor=answer, cache=cache
+                    )
+                    rebuilt = len(section_queries) - built
+                    modified["Q2"] = "2025-02-01T00:00:00Z"
+                    third = tracker.refresh(configs, executor=answer, cache=cache)
+                    # Edited configs are rebuilt, even when no entity changed: a new
+                    # work and title with a feed, a new title alone with snapshots.
+                    edited = dict(configs[0], info=["Q1", "Q3"], site_title="Edited")
+                    fourth = tracker.refresh(
+                        [edited, configs[1]], changes=set(), executor=answer, cache=cache
+                    )
+                    retitled = dict(configs[1], site_title="Edited")
+                    fifth = tracker.refresh([edited, retitled], executor=answer)
+                    added = tracker.compare(edited["filepath"], changes={"Q30"})
+
+        assert [result["written"] for result in first] == [True, True]
+        assert built == 2 * len(wbib.DEFAULT_SESSIONS)
+        assert [result["written"] for result in second] == [True, False]
+        assert set(second[0]["sections"]) == changes.AUTHOR_SECTIONS
+        assert "curation of author items" in second[0]["sections"]
+        assert rebuilt == len(changes.AUTHOR_SECTIONS)
+        assert [result["written"] for result in third] == [False, True]
+        assert third[1]["sections"] == wbib.DEFAULT_SESSIONS
+        assert [result["written"] for result in fourth] == [True, False]
+        assert fourth[0]["sections"] == wbib.DEFAULT_SESSIONS
+        assert [result["written"] for result in fifth] == [False, True]
+        # The work added to the config is followed in the feed from then on.
+        assert added["authors"] == {"Q30"}
+        results = first + second + third + fourth + fifth
+        assert all(result["error"] is None for result in results)
+
+    def test_custom_endpoint_and_embed_url(self):
+        with open("tests/config.yaml") as f2:
+            config = yaml.load(f2, Loader=yaml.FullLoader)
+        config["embed_url"] = "https://mirror.example.org/embed#"
+
+        with tempfile.TemporaryDirectory() as tmp, StubEndpoint(
+            lambda query: {"head": {"vars": []}, "results": {"bindings": []}}
+        ) as endpoint:
+            html = wbib.render_dashboard(
+                config,
+                mode="advanced",
+                filepath=str(Path(tmp).joinpath("x.html")),
+            )
+            config["endpoint"] = endpoint.url
+            wbib.render_dashboard(
+                config,
+                mode="advanced",
+                filepath=str(Path(tmp).joinpath("y.html")),
+                materialize=True,
+            )
+
+        assert html.count('src="https://mirror.example.org/embed#') == 7
+        assert len(endpoint.queries) == 7
+
+    def test_streamed_rendering(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        with tempfile.TemporaryDirectory() as tmp:
+            wbib.enable_bytecode_cache(tmp)
+            try:
+                html = wbib.render_dashboard(
+                    qids, filepath=str(Path(tmp).joinpath("a.html"))
+                )
+                streamed = wbib.render_dashboard(
+                    qids, filepath=str(Path(tmp).joinpath("b.html")), return_html=False
+                )
+                assert list(Path(tmp).glob("__jinja2_*"))
+            finally:
+                wbib.env.bytecode_cache = None
+                wbib._template = None
+
+            assert streamed is None
+            assert Path(tmp).joinpath("b.html").read_text(encoding="utf-8") == html
+
+    def test_instrumentation(self):
+        qids = ["Q35185544", "Q34555562", "Q21284234"]
+        events = []
+        queries.clear_query_cache()
+        with tempfile.TemporaryDirectory() as tmp, StubEndpoint() as endpoint:
+            with instrumentation.hooked(events.append):
+                wbib.render_dashboard(qids, filepath=str(Path(tmp).joinpath("a.html")))
+                wbib.convert_doi_to_qid(["10.3897/RIO.2.E9342"], endpoint=endpoint.url)
+            wbib.render_dashboard(qids, filepath=str(Path(tmp).joinpath("b.html")))
+        assert not instrumentation.enabled()
+
+        spans = {}
+        for event in events:
+            spans.setdefault(event["name"], []).append(event)
+        assert set(spans) == {
+            "render_dashboard",
+            "get_selector",
+            "render_url",
+            "render_section",
+            "render_template",
+            "write_file",
+            "sparql_request",
+            "resolve_identifiers",
+        }
+        assert len(spans["render_dashboard"]) == 1
+        assert len(spans["render_section"]) == len(wbib.DEFAULT_SESSIONS)
+        assert spans["get_selector"][0]["attributes"]["qids"] == 3
+        assert all(e["parent"] == "render_section" for e in spans["render_url"])
+        assert all(e["attributes"]["url_bytes"] > 0 for e in spans["render_url"])
+        assert spans["sparql_request"][0]["attributes"]["status"] == 200
+        assert spans["resolve_identifiers"][0]["attributes"]["qids"] == 1
+
+        with self.assertLogs("wbib", "INFO") as logs:
+            instrumentation.LogExporter()(events[0])
+        assert '"type": "span"' in logs.output[0]
+
     def test_error_in_advanced_rendering(self):
         qids = ["Q35185544", "Q34555562", "Q21284234"]
         with self.assertRaises(TypeError):
@@ -0,0 +1,151 @@
+"""A persistent cache for SPARQL results.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+import time
+
+
+def normalize_query(query):
+    """
+    Collapses whitespace in a query, so that queries that only differ in
+    indentation or line breaks share a cache entry.
+
+    Args:
+        query (str): A SPARQL query.
+
+    Returns:
+        str: The normalized query.
+    """
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class SPARQLCache:
+    """
+    A SQLite-backed cache for SPARQL results, keyed on the endpoint and the
+    normalized query text.
+
+    Entries expire `ttl` seconds after they were stored. When the cache holds
+    more than `max_entries` entries, the least recently used ones are evicted.
+    The `hits` and `misses` attributes count lookups since the cache was opened.
+
+    Args:
+        path (str): The file to store the cache in. Use ":memory:" for a cache that
+            lives only as long as the object.
+        ttl (float): The number of seconds an entry stays valid. Defaults to one day.
+        max_entries (int): The maximum number of entries kept on disk.
+    """
+
+    def __init__(self, path="wbib_cache.sqlite", ttl=86400, max_entries=10000):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                    endpoint TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (endpoint, query)
+                )"""
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)"
+            )
+
+    def get(self, query, endpoint):
+        """
+        Looks up the result of a query.
+
+        Args:
+            query (str): A SPARQL query.
+            endpoint (str): The endpoint the query is sent to.
+
+        Returns:
+            dict: The cached SPARQL JSON results, or None if there is no valid entry.
+        """
+        key = (endpoint, normalize_query(query))
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT result, stored_at FROM results WHERE endpoint = ? AND query = ?",
+                key,
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._connection.execute(
+                        "DELETE FROM results WHERE endpoint = ? AND query = ?", key
+                    )
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE results SET used_at = ? WHERE endpoint = ? AND query = ?",
+                (now,) + key,
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, query, endpoint, result):
+        """
+        Stores the result of a query, evicting the least recently used entries
+        if the cache grows past `max_entries`.
+
+        Args:
+            query (str): A SPARQL query.
+            endpoint (str): The endpoint the query was sent to.
+            result (dict): The SPARQL JSON results.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (endpoint, normalize_query(query), json.dumps(result), now, now),
+            )
+            self._connection.execute(
+                """DELETE FROM results WHERE rowid IN (
+                    SELECT rowid FROM results ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def delete(self, query, endpoint):
+        """
+        Removes the entry of a query, so that it is run again next time.
+
+        Args:
+            query (str): A SPARQL query.
+            endpoint (str): The endpoint the query is sent to.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM results WHERE endpoint = ? AND query = ?",
+                (endpoint, normalize_query(query)),
+            )
+
+    def clear(self):
+        """Removes every entry and resets the counters."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM results")
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
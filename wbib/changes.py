@@ -0,0 +1,359 @@
+"""Tracking the revisions of the entities behind dashboards, to rebuild only stale ones.
+"""
+
+import functools
+import json
+import re
+import sqlite3
+from pathlib import Path
+from wbib import queries, render, sparql
+from wbib.wbib import DEFAULT_QUERY_OPTIONS, DEFAULT_SESSIONS, render_dashboard
+from wbib.wbib import _fingerprint_dashboard
+
+# Sections that show statements or labels of the authors, and not only of the works.
+# The others only need to be rebuilt when a work of the selection changed.
+AUTHOR_SECTIONS = {
+    "map of institutions",
+    "articles",
+    "list of authors",
+    "curation of author items",
+    "curation of author affiliations",
+}
+
+# Arguments of `render_dashboard` that do not change the dashboard it writes.
+_RUN_OPTIONS = {"executor", "return_html", "incremental"}
+
+_QID = re.compile(r"Q\d+")
+
+
+def build_revision_query(info, mode="basic"):
+    """
+    Builds a query returning the last modification date of every work and author
+    selected by a dashboard.
+
+    Args:
+        info: Either a dict containing complex information for the selector or a list of QIDs.
+        mode (str): Either "basic" or "advanced".
+
+    Returns:
+        str: A query returning the ?entity, its ?role ("work" or "author") and the
+            date it was last ?modified.
+    """
+    selector = queries.get_selector(info, mode)
+    return f"""SELECT DISTINCT ?entity ?role ?modified WHERE {{
+  {{ SELECT DISTINCT ?work ?author WHERE {{ {selector} }} }}
+  VALUES ?role {{ "work" "author" }}
+  BIND(IF(?role = "work", ?work, ?author) AS ?entity)
+  ?entity schema:dateModified ?modified .
+}}"""
+
+
+def read_changes(source):
+    """
+    Reads the entities edited according to a recent-changes feed.
+
+    The feed is either one JSON event per line, as recorded from the Wikimedia
+    EventStreams "recentchange" stream (only "wikidatawiki" events on items are
+    kept), or plain text with one QID per line.
+
+    Args:
+        source: The path to the feed, or an iterable of lines.
+
+    Returns:
+        set: The QIDs of the edited items.
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, encoding="utf-8") as lines:
+            return read_changes(list(lines))
+
+    changed = set()
+    for line in source:
+        line = line.strip()
+        if line.startswith("{"):
+            event = json.loads(line)
+            if event.get("wiki", "wikidatawiki") != "wikidatawiki":
+                continue
+            line = event.get("title", "")
+        if _QID.fullmatch(line):
+            changed.add(line)
+    return changed
+
+
+def fingerprint_config(config, sections):
+    """
+    Hashes the arguments of `wbib.wbib.render_dashboard` that shape a dashboard, with
+    the template, so that a dashboard is rebuilt when its config changes.
+
+    Args:
+        config (dict): Keyword arguments for `render_dashboard`.
+        sections (list): The names of the sections of the dashboard.
+
+    Returns:
+        str: The fingerprint.
+    """
+    context = {
+        key: value
+        for key, value in config.items()
+        if key not in _RUN_OPTIONS | {"info", "mode"}
+    }
+    return _fingerprint_dashboard(
+        config["info"], config.get("mode", "basic"), sections, context
+    )
+
+
+class ChangeTracker:
+    """
+    Remembers the works and authors of each dashboard, with their last modification
+    dates, and a fingerprint of its config, in a SQLite file.
+
+    On the next run, a dashboard is compared either with a fresh snapshot of its
+    entities (one light query per dashboard) or with a recent-changes feed (no
+    query at all). Only the dashboards, and the sections, whose entities changed
+    need to be rebuilt; see `refresh`.
+
+    A feed only reveals edits to entities already recorded: works that start
+    matching an "advanced" selector are only noticed by a snapshot.
+
+    Args:
+        path (str): The file to store the revisions in. Use ":memory:" for a tracker
+            that is not kept.
+    """
+
+    def __init__(self, path="wbib_changes.sqlite"):
+        self.path = str(path)
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS entities (
+                    dashboard TEXT NOT NULL,
+                    entity TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    modified TEXT NOT NULL,
+                    PRIMARY KEY (dashboard, entity, role)
+                )"""
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS dashboards (
+                    dashboard TEXT PRIMARY KEY,
+                    fingerprint TEXT
+                )"""
+            )
+
+    def snapshot(self, info, mode="basic", executor=None):
+        """
+        Fetches the last modification dates of the works and authors of a dashboard.
+
+        Args:
+            info: Either a dict containing complex information for the selector or a list of QIDs.
+            mode (str): Either "basic" or "advanced".
+            executor (function): Takes a SPARQL query and returns the SPARQL JSON results.
+                Defaults to `wbib.sparql.perform_query` on the public WDQS.
+
+        Returns:
+            dict: The modification date of each (QID, role) pair.
+        """
+        if executor is None:
+            executor = sparql.perform_query
+        result = executor(build_revision_query(info, mode))
+        return {
+            (row["entity"].rsplit("/", 1)[-1], row["role"]): row["modified"]
+            for row in sparql.iter_json_rows(result)
+        }
+
+    def _recorded(self, dashboard):
+        rows = self._connection.execute(
+            "SELECT entity, role, modified FROM entities WHERE dashboard = ?",
+            (dashboard,),
+        )
+        return {(entity, role): modified for entity, role, modified in rows}
+
+    def _recorded_fingerprint(self, dashboard):
+        row = self._connection.execute(
+            "SELECT fingerprint FROM dashboards WHERE dashboard = ?", (dashboard,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def compare(self, dashboard, snapshot=None, changes=None, fingerprint=None):
+        """
+        Finds the entities of a dashboard that changed since it was recorded.
+
+        Args:
+            dashboard (str): The name the dashboard was recorded under.
+            snapshot (dict): A fresh snapshot from `snapshot`. Entities added to or
+                removed from the selection count as changed.
+            changes (set): QIDs edited since the last run, from `read_changes`.
+                Used when no snapshot is given.
+            fingerprint (str): The fingerprint of the current config of the dashboard
+                (see `fingerprint_config`). Defaults to None (the config is not compared).
+
+        Returns:
+            dict: The changed "works" and "authors" (sets of QIDs), and whether the
+                dashboard is "new", that is, was never recorded or its config changed.
+        """
+        recorded = self._recorded(dashboard)
+        new = not recorded
+        if fingerprint is not None:
+            new = new or fingerprint != self._recorded_fingerprint(dashboard)
+        report = {"works": set(), "authors": set(), "new": new}
+        if snapshot is not None:
+            changed = set(recorded.items()) ^ set(snapshot.items())
+            changed = set(key for key, modified in changed)
+        else:
+            changed = set(key for key in recorded if key[0] in (changes or ()))
+        for entity, role in changed:
+            report[role + "s"].add(entity)
+        return report
+
+    def record(self, dashboard, snapshot, fingerprint=None):
+        """
+        Stores the snapshot of a dashboard, replacing the previous one.
+
+        Args:
+            dashboard (str): The name to record the dashboard under.
+            snapshot (dict): A snapshot from `snapshot`.
+            fingerprint (str): The fingerprint of the config the dashboard was
+                rendered from (see `fingerprint_config`).
+        """
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM entities WHERE dashboard = ?", (dashboard,)
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO dashboards VALUES (?, ?)",
+                (dashboard, fingerprint),
+            )
+            self._connection.executemany(
+                "INSERT INTO entities VALUES (?, ?, ?, ?)",
+                (
+                    (dashboard, entity, role, modified)
+                    for (entity, role), modified in snapshot.items()
+                ),
+            )
+
+    @staticmethod
+    def stale_sections(sections, report):
+        """
+        Picks the sections to rebuild from the report of `compare`.
+
+        Args:
+            sections (list): The names of the sections of the dashboard.
+            report (dict): The report of `compare`.
+
+        Returns:
+            list: The sections whose inputs changed: all of them when works changed or
+                the dashboard is new, the AUTHOR_SECTIONS when only authors changed.
+        """
+        if report["new"] or report["works"]:
+            return list(sections)
+        if report["authors"]:
+            return [section for section in sections if section in AUTHOR_SECTIONS]
+        return []
+
+    def refresh(self, configs, changes=None, executor=None, cache=None):
+        """
+        Rebuilds the dashboards whose works or authors, or whose config, changed since
+        the last refresh, with `wbib.wbib.render_dashboard`, and records their new
+        snapshots.
+
+        Materialized dashboards read their unchanged sections from `cache`: only the
+        queries of the stale sections are run again. Dashboards whose sections are
+        combined into one query are rebuilt whole.
+
+        Args:
+            configs (list): Keyword arguments for `render_dashboard`, one dict per
+                dashboard. Each dashboard is recorded under its "filepath".
+            changes (set): QIDs edited since the last refresh, from `read_changes`.
+                Dashboards are then checked against the feed, and only the stale ones
+                are queried for a new snapshot. Defaults to None (a snapshot of every
+                dashboard is compared instead).
+            executor (function): Runs the revision queries, and the section queries of
+                configs without their own executor. Defaults to
+                `wbib.sparql.perform_query` on the endpoint of each config.
+            cache (wbib.cache.SPARQLCache): The cache holding the section results of
+                materialized dashboards across refreshes. Defaults to None (stale
+                dashboards are rebuilt whole).
+
+        Returns:
+            list: One dict per config, with the "config", the "sections" rebuilt
+                (empty when the dashboard was skipped), whether it was "written",
+                and the "error" raised, or None.
+        """
+        results = []
+        for config in configs:
+            result = {"config": config, "sections": [], "written": False, "error": None}
+            try:
+                self._refresh_dashboard(config, changes, executor, cache, result)
+            except Exception as error:
+                result["error"] = error
+            results.append(result)
+        return results
+
+    def _refresh_dashboard(self, config, changes, executor, cache, result):
+        config = dict(config)
+        info = config["info"]
+        mode = config.get("mode", "basic")
+        dashboard = str(config.get("filepath", "."))
+        endpoint = config.get("endpoint")
+        embed_url = config.get("embed_url")
+        if mode == "advanced":
+            endpoint = endpoint or info.get("endpoint")
+            embed_url = embed_url or info.get("embed_url")
+            sections = info["sections"]
+        else:
+            sections = config.get("sections_to_add", DEFAULT_SESSIONS)
+        endpoint = endpoint or sparql.WDQS_ENDPOINT
+        if executor is None:
+            executor = functools.partial(sparql.perform_query, endpoint=endpoint)
+
+        fingerprint = fingerprint_config(config, sections)
+        snapshot = None
+        if changes is None:
+            snapshot = self.snapshot(info, mode, executor)
+        report = self.compare(dashboard, snapshot, changes, fingerprint)
+        stale = self.stale_sections(sections, report)
+        if not stale:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot(info, mode, executor)
+
+        section_executor = config.get("executor", executor)
+        partial = not config.get("combine_sections")
+        if config.get("materialize") and cache is not None and partial:
+            for section in render.render_sections(
+                stale,
+                config.get("query_options", DEFAULT_QUERY_OPTIONS),
+                info,
+                mode,
+                max_url_bytes=config.get("max_url_bytes"),
+                embed_url=embed_url,
+            ):
+                for url in section["shards"]:
+                    cache.delete(queries.query_from_url(url, embed_url), endpoint)
+            config["executor"] = functools.partial(
+                _cached, section_executor, cache, endpoint
+            )
+        else:
+            stale = list(sections)
+            config["executor"] = section_executor
+
+        render_dashboard(**config)
+        self.record(dashboard, snapshot, fingerprint)
+        result["sections"] = stale
+        result["written"] = True
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _cached(executor, cache, endpoint, query):
+    result = cache.get(query, endpoint)
+    if result is None:
+        result = executor(query)
+        cache.set(query, endpoint, result)
+    return result
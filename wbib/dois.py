@@ -0,0 +1,219 @@
+"""Reading DOIs lazily from reference-manager exports and other large files.
+"""
+
+import csv
+import functools
+import gzip
+import io
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+# Number of distinct DOIs remembered by `deduplicate` by default.
+DEDUPLICATION_WINDOW = 1000000
+
+# DOIs as they are found in free text. Explicit DOIs only need the "10." prefix and
+# a slash, as older ones, such as SICIs, hold any character.
+DOI_PATTERN = re.compile(r"10\.\d{4,9}/[^\s\"'<>{},;]+")
+_DOI_SHAPE = re.compile(r"10\.[^/]+/.+", re.DOTALL)
+
+_DOI_PREFIXES = re.compile(r"^(?:doi:\s*|https?://(?:dx\.)?doi\.org/)", re.IGNORECASE)
+_RIS_DOI_LINE = re.compile(r"^(?:DO|DI|UR|L3|M3)\s{2}-\s(.*)$")
+_BIBTEX_DOI_FIELD = re.compile(r"\bdoi\s*=\s*[{\"]\s*([^}\"]+?)\s*[}\"]", re.IGNORECASE)
+
+_FORMATS = {
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".ris": "ris",
+    ".bib": "bibtex",
+    ".bibtex": "bibtex",
+}
+
+
+def normalize_doi(text, strict=False):
+    """
+    Brings a DOI to the form stored on Wikidata: without "doi:" or resolver
+    prefixes, without surrounding whitespace, in upper case.
+
+    Args:
+        text (str): A DOI, possibly as a "https://doi.org/..." link.
+        strict (bool): If True, trailing punctuation is dropped and the DOI needs to
+            match DOI_PATTERN, as when it is read from free text. Otherwise anything
+            starting with "10." is accepted, such as the SICI
+            "10.1002/(SICI)1097-4636(199706)35:4<447::AID-JBM5>3.0.CO;2-D".
+            Defaults to False.
+
+    Returns:
+        str: The normalized DOI, or None if `text` does not hold a DOI.
+    """
+    text = _DOI_PREFIXES.sub("", text.strip()).strip()
+    if strict:
+        text = text.rstrip(".,;")
+    pattern = DOI_PATTERN if strict else _DOI_SHAPE
+    if not pattern.fullmatch(text):
+        return None
+    return text.upper()
+
+
+def open_text(path):
+    """
+    Opens a text file for reading, decompressing it on the fly if it is gzipped.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        A file object yielding lines of text.
+    """
+    with open(path, "rb") as raw:
+        magic = raw.read(2)
+    if magic == b"\x1f\x8b":
+        return io.TextIOWrapper(gzip.open(path), encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace", newline="")
+
+
+def guess_format(path):
+    """
+    Guesses the format of a DOI source from its file name, ignoring a ".gz" suffix.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        str: One of "csv", "tsv", "ris", "bibtex" or "lines".
+    """
+    suffixes = [suffix.lower() for suffix in Path(path).suffixes]
+    if suffixes and suffixes[-1] == ".gz":
+        suffixes.pop()
+    return _FORMATS.get(suffixes[-1] if suffixes else "", "lines")
+
+
+def _dois_from_lines(lines):
+    for line in lines:
+        doi = normalize_doi(line, strict=True)
+        if doi is None:
+            match = DOI_PATTERN.search(line)
+            doi = normalize_doi(match.group(0), strict=True) if match else None
+        if doi is not None:
+            yield doi
+
+
+def _dois_from_csv(lines, delimiter=","):
+    rows = csv.reader(lines, delimiter=delimiter)
+    header = next(rows, None)
+    if header is None:
+        return
+    names = [name.strip().lower() for name in header]
+    if "doi" not in names:
+        # No DOI column: take every field that holds a DOI, the first row included.
+        yield from _dois_from_lines(header)
+        for row in rows:
+            yield from _dois_from_lines(row)
+        return
+    index = names.index("doi")
+    for row in rows:
+        if index < len(row):
+            doi = normalize_doi(row[index])
+            if doi is not None:
+                yield doi
+
+
+def _dois_from_ris(lines):
+    for line in lines:
+        match = _RIS_DOI_LINE.match(line)
+        if match:
+            doi = normalize_doi(match.group(1))
+            if doi is not None:
+                yield doi
+
+
+def _dois_from_bibtex(lines):
+    for line in lines:
+        for match in _BIBTEX_DOI_FIELD.finditer(line):
+            doi = normalize_doi(match.group(1).replace("\\_", "_"))
+            if doi is not None:
+                yield doi
+
+
+_READERS = {
+    "lines": _dois_from_lines,
+    "csv": _dois_from_csv,
+    "tsv": functools.partial(_dois_from_csv, delimiter="\t"),
+    "ris": _dois_from_ris,
+    "bibtex": _dois_from_bibtex,
+}
+
+
+def read_dois(source, format=None):
+    """
+    Reads DOIs one at a time from a file or from an iterable of lines.
+
+    Supported formats:
+        "lines": any text with DOIs in it, such as one DOI or DOI link per line.
+        "csv": a CSV file with a "doi" column; without one, DOIs are taken from every field.
+        "tsv": the same, separated by tabs.
+        "ris": the DO (and UR) fields of a RIS export.
+        "bibtex": the doi fields of a BibTeX file. Each field needs to be on a single line.
+
+    Args:
+        source: The path to a file, optionally gzipped, or an iterable of lines.
+        format (str): One of the formats above. Defaults to a guess from the file name,
+            or "lines" for iterables.
+
+    Yields:
+        str: Normalized DOIs (see `normalize_doi`), in the order they appear.
+    """
+    if isinstance(source, (str, Path)):
+        if format is None:
+            format = guess_format(source)
+        with open_text(source) as lines:
+            yield from _READERS[format](lines)
+    else:
+        yield from _READERS[format or "lines"](source)
+
+
+def deduplicate(dois, window=DEDUPLICATION_WINDOW):
+    """
+    Drops repeated DOIs while keeping memory bounded.
+
+    The last `window` distinct DOIs are remembered, so a DOI is dropped if it was
+    seen recently. A DOI repeated after more than `window` other DOIs is let through
+    again; resolving it twice is harmless, only slower.
+
+    Args:
+        dois (iterable): DOIs, normalized so that equal DOIs are equal strings.
+        window (int): The number of distinct DOIs remembered.
+
+    Yields:
+        str: The DOIs not seen within the window.
+    """
+    seen = OrderedDict()
+    for doi in dois:
+        if doi in seen:
+            seen.move_to_end(doi)
+            continue
+        seen[doi] = None
+        if len(seen) > window:
+            seen.popitem(last=False)
+        yield doi
+
+
+def chunked(items, chunk_size):
+    """
+    Groups an iterable into lists of at most `chunk_size` items.
+
+    Args:
+        items (iterable): Any iterable.
+        chunk_size (int): The maximum size of a chunk.
+
+    Yields:
+        list: The chunks, in order.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
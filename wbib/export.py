@@ -0,0 +1,245 @@
+"""Exporting the results of the dashboard sections as typed Arrow or Parquet files.
+
+Each section becomes one file with a column per query variable, and a manifest
+lists the files. Entities are stored as integer QIDs, integer and decimal literals
+as numbers, and dates as dates. Arrow files are written uncompressed, so that they
+can be memory-mapped and read without copies:
+
+    table = export.read_table("export/list_of_authors.arrow")
+
+Needs the pyarrow package.
+"""
+
+import datetime
+import json
+import re
+from pathlib import Path
+from wbib import instrumentation, queries
+
+# pyarrow is imported where it is used, as it is only needed for exports.
+
+MANIFEST_NAME = "manifest.json"
+
+# File suffix of each export format.
+FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+INTEGER_DATATYPES = {
+    _XSD + name
+    for name in ["integer", "int", "long", "short", "nonNegativeInteger"]
+}
+FLOAT_DATATYPES = {_XSD + name for name in ["decimal", "double", "float"]}
+DATE_DATATYPES = {_XSD + "dateTime", _XSD + "date"}
+BOOLEAN_DATATYPES = {_XSD + "boolean"}
+
+_QID_URI = re.compile(r"http://www\.wikidata\.org/entity/Q(\d+)")
+_DATE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+def _parse_date(value):
+    """Returns the date of an xsd:date or xsd:dateTime, or None outside 1-9999 AD."""
+    match = _DATE.match(value)
+    if match is None:
+        return None
+    try:
+        return datetime.date(*(int(part) for part in match.groups()))
+    except ValueError:
+        return None
+
+
+def _column_type(cells):
+    """
+    Picks the type of a column from its bound cells: "qid", "int64", "float64",
+    "date32", "bool" or, when the cells disagree, "string".
+    """
+    if not cells:
+        return "string"
+    if all(
+        cell["type"] == "uri" and _QID_URI.fullmatch(cell["value"]) for cell in cells
+    ):
+        return "qid"
+    if any(cell["type"] != "literal" for cell in cells):
+        return "string"
+    datatypes = set(cell.get("datatype") for cell in cells)
+    if datatypes <= INTEGER_DATATYPES:
+        return "int64"
+    if datatypes <= INTEGER_DATATYPES | FLOAT_DATATYPES:
+        return "float64"
+    if datatypes <= DATE_DATATYPES:
+        return "date32"
+    if datatypes <= BOOLEAN_DATATYPES:
+        return "bool"
+    return "string"
+
+
+_CONVERTERS = {
+    "qid": lambda value: int(_QID_URI.fullmatch(value).group(1)),
+    "int64": int,
+    "float64": float,
+    "date32": _parse_date,
+    "bool": lambda value: value in ("true", "1"),
+    "string": str,
+}
+
+
+def results_to_arrow(results):
+    """
+    Converts SPARQL JSON results into an Arrow table with typed columns.
+
+    Args:
+        results (list): SPARQL JSON results with the same variables, such as the
+            results of the shards of a section. Their rows are concatenated.
+
+    Returns:
+        pyarrow.Table: One column per variable. Unbound values are nulls.
+    """
+    import pyarrow
+
+    columns = []
+    for result in results:
+        columns.extend(name for name in result["head"]["vars"] if name not in columns)
+    bindings = [
+        binding for result in results for binding in result["results"]["bindings"]
+    ]
+
+    arrow_types = {
+        "int64": pyarrow.int64(),
+        "float64": pyarrow.float64(),
+        "date32": pyarrow.date32(),
+        "bool": pyarrow.bool_(),
+        "string": pyarrow.string(),
+    }
+    arrays = []
+    qid_columns = []
+    for column in columns:
+        cells = [binding[column] for binding in bindings if column in binding]
+        column_type = _column_type(cells)
+        convert = _CONVERTERS[column_type]
+        values = [
+            convert(binding[column]["value"]) if column in binding else None
+            for binding in bindings
+        ]
+        if column_type == "qid":
+            qid_columns.append(column)
+            column_type = "int64"
+        arrays.append(pyarrow.array(values, type=arrow_types[column_type]))
+    table = pyarrow.Table.from_arrays(arrays, names=columns)
+    # QID columns are plain integers to Arrow; the metadata tells them apart.
+    return table.replace_schema_metadata({"wbib:qid_columns": ",".join(qid_columns)})
+
+
+def _file_name(legend, suffix):
+    return re.sub(r"[^a-z0-9]+", "_", legend.lower()).strip("_") + suffix
+
+
+def write_table(table, path, format="arrow"):
+    """
+    Writes an Arrow table to disk.
+
+    Args:
+        table (pyarrow.Table): The table.
+        path (str): The path of the file.
+        format (str): "arrow" for an uncompressed Arrow IPC file, which can be
+            memory-mapped, or "parquet".
+    """
+    import pyarrow
+
+    if format == "parquet":
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(table, str(path))
+    else:
+        with pyarrow.OSFile(str(path), "wb") as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def read_table(path):
+    """
+    Reads a file written by `export_sections`. Arrow files are memory-mapped, so the
+    columns are read from the page cache without copies.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        pyarrow.Table: The table.
+    """
+    import pyarrow
+
+    if str(path).endswith(FORMATS["parquet"]):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(str(path), memory_map=True)
+    return pyarrow.ipc.open_file(pyarrow.memory_map(str(path))).read_all()
+
+
+def export_sections(sections, directory, executor=None, format="arrow", embed_url=None):
+    """
+    Writes the results of rendered sections to one file per section, and a manifest.
+
+    Materialized sections (see `wbib.render.materialize_sections`) are exported from
+    the results they already hold; the queries of the other sections are run through
+    `executor`, one per shard.
+
+    Args:
+        sections (list): Sections from `wbib.render.render_sections`.
+        directory (str): The directory to write to. It is created if needed.
+        executor (function): Takes a SPARQL query and returns the SPARQL JSON results,
+            such as `wbib.sparql.perform_query`. Only needed for sections that were
+            not materialized.
+        format (str): One of FORMATS. Defaults to "arrow".
+        embed_url (str): The prefix the section URLs were built with, if not the default.
+
+    Returns:
+        dict: The manifest, also written to MANIFEST_NAME in `directory`. Its
+            "sections" list has the "legend", "query", "file", "rows" and "columns"
+            (name and type) of each section.
+    """
+    if format not in FORMATS:
+        raise ValueError(
+            "'format' needs to be one of {}".format(", ".join(sorted(FORMATS)))
+        )
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    manifest = {"format": format, "sections": []}
+    for section in sections:
+        span = instrumentation.span("export_section", section=section["legend"])
+        with span as attributes:
+            data = section.get("data")
+            if data is None:
+                if executor is None:
+                    raise ValueError(
+                        "Sections that were not materialized need an 'executor'"
+                    )
+                data = [
+                    executor(queries.query_from_url(url, embed_url))
+                    for url in section["shards"]
+                ]
+            table = results_to_arrow(data)
+            file_name = _file_name(section["legend"], FORMATS[format])
+            write_table(table, directory.joinpath(file_name), format)
+            if attributes is not None:
+                attributes["rows"] = table.num_rows
+
+        qid_columns = table.schema.metadata[b"wbib:qid_columns"].decode().split(",")
+
+        manifest["sections"].append(
+            {
+                "legend": section["legend"],
+                "query": section["query"],
+                "file": file_name,
+                "rows": table.num_rows,
+                "columns": [
+                    {
+                        "name": field.name,
+                        "type": "qid" if field.name in qid_columns else str(field.type),
+                    }
+                    for field in table.schema
+                ],
+            }
+        )
+
+    directory.joinpath(MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+    return manifest
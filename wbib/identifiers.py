@@ -0,0 +1,144 @@
+"""Normalization and lookup queries for the external identifiers of works and authors.
+"""
+
+import re
+from wbib import dois
+
+# Wikidata property of each supported identifier type.
+PROPERTIES = {
+    "doi": "P356",
+    "pmid": "P698",
+    "pmcid": "P932",
+    "arxiv": "P818",
+    "orcid": "P496",
+}
+
+_ARXIV_PATTERN = re.compile(
+    r"(\d{4}\.\d{4,5}|[a-z][a-z\-]*(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?", re.IGNORECASE
+)
+_ORCID_PATTERN = re.compile(r"(\d{4})-?(\d{4})-?(\d{4})-?(\d{3}[\dX])", re.IGNORECASE)
+_PREFIXES = {
+    "pmid": re.compile(r"^pmid:\s*", re.IGNORECASE),
+    "pmcid": re.compile(r"^(?:pmcid:\s*)?(?:pmc)?", re.IGNORECASE),
+    "arxiv": re.compile(r"^(?:arxiv:\s*|https?://arxiv\.org/abs/)", re.IGNORECASE),
+    "orcid": re.compile(r"^(?:orcid:\s*|https?://orcid\.org/)", re.IGNORECASE),
+}
+_EXPLICIT_TYPE = re.compile(r"^(doi|pmid|pmcid|arxiv|orcid):", re.IGNORECASE)
+_PMCID_SHAPE = re.compile(r"^\s*pmc\d", re.IGNORECASE)
+
+# Types tried, in order, when guessing the type of an identifier. A 16-digit ORCID
+# without hyphens is a number too, so ORCIDs are tried before PubMed IDs.
+_DETECTION_ORDER = ["doi", "orcid", "arxiv", "pmcid", "pmid"]
+
+
+def _normalize_number(text, prefix):
+    text = prefix.sub("", text.strip())
+    if not text.isdigit():
+        return None
+    return str(int(text))
+
+
+def _normalize_arxiv(text):
+    match = _ARXIV_PATTERN.fullmatch(_PREFIXES["arxiv"].sub("", text.strip()))
+    return match.group(1) if match else None
+
+
+def _normalize_orcid(text):
+    match = _ORCID_PATTERN.fullmatch(_PREFIXES["orcid"].sub("", text.strip()))
+    return "-".join(match.groups()).upper() if match else None
+
+
+_NORMALIZERS = {
+    "doi": dois.normalize_doi,
+    "pmid": lambda text: _normalize_number(text, _PREFIXES["pmid"]),
+    "pmcid": lambda text: _normalize_number(text, _PREFIXES["pmcid"]),
+    "arxiv": _normalize_arxiv,
+    "orcid": _normalize_orcid,
+}
+
+
+def normalize_identifier(value, kind):
+    """
+    Brings an identifier to the form stored on Wikidata.
+
+    DOIs are upper-cased, PubMed IDs and PMCIDs lose their "PMID:"/"PMC" prefixes
+    and leading zeros, arXiv IDs lose their version, and ORCIDs are hyphenated.
+    Resolver links such as "https://doi.org/..." or "https://orcid.org/..." are accepted.
+
+    Args:
+        value (str): The identifier.
+        kind (str): One of the keys of PROPERTIES.
+
+    Returns:
+        str: The normalized identifier, or None if `value` is not a valid `kind` identifier.
+    """
+    return _NORMALIZERS[kind](value)
+
+
+def detect_identifier(value):
+    """
+    Guesses the type of an identifier and normalizes it.
+
+    Explicit prefixes such as "pmid:" or "arxiv:" are honored. Otherwise DOIs,
+    PMCIDs ("PMC..."), ORCIDs and arXiv IDs are recognized by their shape, and
+    plain numbers are taken to be PubMed IDs.
+
+    Args:
+        value (str): The identifier.
+
+    Returns:
+        tuple: (kind, normalized value), or (None, None) if the type is not recognized.
+    """
+    explicit = _EXPLICIT_TYPE.match(value.strip())
+    kinds = [explicit.group(1).lower()] if explicit else _DETECTION_ORDER
+    for kind in kinds:
+        # Without a prefix, only numbers starting with "PMC" are PMCIDs.
+        if kind == "pmcid" and not explicit and not _PMCID_SHAPE.match(value):
+            continue
+        normalized = normalize_identifier(value, kind)
+        if normalized is not None:
+            return kind, normalized
+    return None, None
+
+
+def build_lookup_query(values, kind):
+    """
+    Builds a query finding the items holding any of the given identifiers.
+
+    Args:
+        values (list): Normalized identifiers, all of the same type.
+        kind (str): One of the keys of PROPERTIES.
+
+    Returns:
+        str: A query returning the identifier as ?id and the item as ?item.
+    """
+    formatted_values = " ".join(
+        '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values
+    )
+    return f"""SELECT ?id ?item
+  WHERE {{
+      VALUES ?id {{ {formatted_values} }}
+      ?item wdt:{PROPERTIES[kind]} ?id.
+  }}
+  """
+
+
+def match_rows(identifiers_by_value, rows):
+    """
+    Maps the rows of a lookup query back to the identifiers as they were given.
+
+    Args:
+        identifiers_by_value (dict): Lists of identifiers as given, keyed on their
+            normalized value.
+        rows (iterable): Result rows with "id" and "item" values,
+            as yielded by `wbib.sparql.AsyncSPARQLClient.iter_rows`.
+
+    Returns:
+        list: (identifier, qid) pairs.
+    """
+    pairs = []
+    for row in rows:
+        qid = row["item"].rsplit("/", 1)[-1]
+        for identifier in identifiers_by_value.get(row["id"], ()):
+            pairs.append((identifier, qid))
+    return pairs
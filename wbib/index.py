@@ -0,0 +1,294 @@
+"""An offline index of the external identifiers on Wikidata, built from a JSON dump.
+
+`build_index` reads a Wikidata JSON dump (such as latest-all.json.bz2) once and
+writes the identifiers it finds, with the QIDs holding them, to a sorted binary
+file. `IdentifierIndex` memory-maps that file and looks identifiers up by binary
+search, so resolving even millions of identifiers needs neither the network nor
+much memory:
+
+    index.build_index("latest-all.json.bz2", "identifiers.idx", kinds=["doi", "pmid"])
+    with index.IdentifierIndex("identifiers.idx") as doi_index:
+        wbib.convert_doi_to_qid(list_of_dois, index=doi_index)
+
+The index reflects Wikidata at the date of the dump.
+"""
+
+import bz2
+import functools
+import gzip
+import heapq
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from wbib import dois, identifiers
+
+MAGIC = b"WBIBIDX1"
+
+# Magic bytes, number of entries, offset of the tables and the identifier types indexed.
+_HEADER = struct.Struct("<8sQQ64s")
+
+# Number of dump lines parsed per task, and number of entries sorted in memory at once.
+LINES_PER_TASK = 2000
+RUN_SIZE = 1000000
+
+_PROPERTY_KINDS = {
+    property_id: kind for kind, property_id in identifiers.PROPERTIES.items()
+}
+
+
+def open_dump(path):
+    """
+    Opens a Wikidata JSON dump for reading, decompressing it on the fly if it is
+    compressed with bzip2 or gzip.
+
+    Args:
+        path (str): The path to the dump.
+
+    Returns:
+        A binary file object.
+    """
+    with open(path, "rb") as raw:
+        magic = raw.read(3)
+    if magic == b"BZh":
+        return bz2.open(path)
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.open(path)
+    return open(path, "rb")
+
+
+def _truthy_values(claims):
+    """Returns the values of the best-ranked statements, as wdt: properties do."""
+    values = {"preferred": [], "normal": []}
+    for claim in claims:
+        snak = claim.get("mainsnak", {})
+        if claim.get("rank") in values and snak.get("snaktype") == "value":
+            values[claim["rank"]].append(snak["datavalue"]["value"])
+    return values["preferred"] or values["normal"]
+
+
+def _extract_identifiers(lines, properties):
+    """
+    Parses dump lines, returning (key, QID number) pairs for the identifiers held
+    on the given properties.
+    """
+    markers = [('"' + property_id + '"').encode("ascii") for property_id in properties]
+    entries = []
+    for line in lines:
+        # Most entities hold none of the properties; they are not parsed at all.
+        if not any(marker in line for marker in markers):
+            continue
+        line = line.strip().rstrip(b",")
+        if not line.startswith(b"{"):
+            continue
+        entity = json.loads(line)
+        entity_id = entity.get("id", "")
+        if not entity_id.startswith("Q"):
+            continue
+        claims = entity.get("claims", {})
+        for property_id in properties:
+            kind = _PROPERTY_KINDS[property_id]
+            for value in _truthy_values(claims.get(property_id, ())):
+                value = identifiers.normalize_identifier(value, kind)
+                if value is not None:
+                    entries.append((_key(value, kind), int(entity_id[1:])))
+    return entries
+
+
+def _key(value, kind):
+    return (kind + ":" + value).encode("utf-8")
+
+
+def _write_run(entries, directory):
+    # Runs are sorted on their encoded lines, the order `_merge_runs` reads them in.
+    lines = sorted(
+        key + b"\t" + str(qid).encode("ascii") + b"\n" for key, qid in entries
+    )
+    run = tempfile.TemporaryFile(dir=directory)
+    run.writelines(lines)
+    run.seek(0)
+    return run
+
+
+def _merge_runs(runs):
+    """Merges sorted runs into (key, QID number) pairs, dropping repeated pairs."""
+    previous = None
+    for line in heapq.merge(*runs):
+        if line == previous:
+            continue
+        previous = line
+        key, qid = line.rstrip(b"\n").rsplit(b"\t", 1)
+        yield key, int(qid)
+
+
+def _write_index(entries, path, kinds, directory):
+    offsets = tempfile.TemporaryFile(dir=directory)
+    qids = tempfile.TemporaryFile(dir=directory)
+    count = 0
+    with open(path, "wb") as index_file:
+        index_file.write(b"\0" * _HEADER.size)
+        position = _HEADER.size
+        for key, qid in entries:
+            offsets.write(struct.pack("<Q", position))
+            qids.write(struct.pack("<I", qid))
+            index_file.write(key)
+            position += len(key)
+            count += 1
+        offsets.write(struct.pack("<Q", position))
+        # The tables are aligned, so that they can be read in place.
+        padding = -position % 8
+        index_file.write(b"\0" * padding)
+        for table in (offsets, qids):
+            table.seek(0)
+            shutil.copyfileobj(table, index_file)
+            table.close()
+        index_file.seek(0)
+        index_file.write(
+            _HEADER.pack(MAGIC, count, position + padding, ",".join(kinds).encode())
+        )
+    return count
+
+
+def build_index(dump_path, index_path, kinds=("doi",), processes=None):
+    """
+    Builds an identifier index from a Wikidata JSON dump.
+
+    The dump is read and decompressed in this process, while its lines are parsed in
+    `processes` worker processes. Only entities mentioning one of the properties are
+    parsed. The identifiers found are normalized (see
+    `wbib.identifiers.normalize_identifier`) and sorted on disk, in runs of at most
+    RUN_SIZE entries, so memory use does not grow with the size of the dump.
+
+    Args:
+        dump_path (str): The path to the dump, optionally compressed with bzip2 or gzip.
+        index_path (str): The path of the index to write. It is replaced only once
+            the new index is complete.
+        kinds (list): The identifier types to index, among the keys of
+            `wbib.identifiers.PROPERTIES`. Defaults to DOIs only.
+        processes (int): The number of worker processes. Defaults to the number of
+            CPUs; 1 parses the dump in this process.
+
+    Returns:
+        int: The number of (identifier, QID) entries in the index.
+    """
+    index_path = str(index_path)
+    kinds = sorted(set(kinds))
+    properties = [identifiers.PROPERTIES[kind] for kind in kinds]
+    extract = functools.partial(_extract_identifiers, properties=properties)
+    directory = os.path.dirname(os.path.abspath(index_path))
+
+    runs = []
+    entries = []
+    with open_dump(dump_path) as dump:
+        batches = dois.chunked(dump, LINES_PER_TASK)
+        if processes == 1:
+            parsed = map(extract, batches)
+            pool = None
+        else:
+            from multiprocessing import Pool
+
+            pool = Pool(processes)
+            parsed = pool.imap(extract, batches)
+        try:
+            for batch_entries in parsed:
+                entries.extend(batch_entries)
+                if len(entries) >= RUN_SIZE:
+                    runs.append(_write_run(entries, directory))
+                    entries = []
+        finally:
+            if pool is not None:
+                pool.terminate()
+    runs.append(_write_run(entries, directory))
+
+    partial_path = index_path + ".partial"
+    try:
+        count = _write_index(_merge_runs(runs), partial_path, kinds, directory)
+    finally:
+        for run in runs:
+            run.close()
+    os.replace(partial_path, index_path)
+    return count
+
+
+class IdentifierIndex:
+    """
+    A memory-mapped index built by `build_index`.
+
+    Lookups are binary searches over the sorted identifiers, reading only the pages
+    of the file they touch.
+
+    Args:
+        path (str): The path to the index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, table, kinds = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{} is not an identifier index".format(path))
+        self.kinds = set(kinds.rstrip(b"\0").decode().split(","))
+        self._count = count
+
+        qid_table = table + 8 * (count + 1)
+        self._view = None
+        if sys.byteorder == "little":
+            self._view = memoryview(self._map)
+            self._offsets = self._view[table:qid_table].cast("Q")
+            self._qids = self._view[qid_table : qid_table + 4 * count].cast("I")
+        else:
+            self._offsets = array("Q", self._map[table:qid_table])
+            self._qids = array("I", self._map[qid_table : qid_table + 4 * count])
+            self._offsets.byteswap()
+            self._qids.byteswap()
+
+    def _key_at(self, position):
+        return self._map[self._offsets[position] : self._offsets[position + 1]]
+
+    def lookup(self, value, kind="doi"):
+        """
+        Finds the items holding an identifier.
+
+        Args:
+            value (str): The normalized identifier (see `wbib.identifiers.normalize_identifier`).
+            kind (str): Its type, one of `kinds`.
+
+        Returns:
+            list: The QIDs holding the identifier, possibly empty.
+        """
+        key = _key(value, kind)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        qids = []
+        while low < self._count and self._key_at(low) == key:
+            qids.append("Q" + str(self._qids[low]))
+            low += 1
+        return qids
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            # The views into the map need to be released before it can be closed.
+            for view in (self._offsets, self._qids, self._view):
+                view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,248 @@
+"""Timing spans and counters for the hot paths of wbib.
+
+Nothing is measured until a hook is added, so the instrumentation costs a single
+check per call when it is not used. A hook is any callable that takes an event dict:
+
+    events = []
+    with instrumentation.hooked(events.append):
+        wbib.render_dashboard(qids)
+
+Span events look like {"type": "span", "name": "render_url", "start": 1634567890.1,
+"seconds": 0.002, "attributes": {"url_bytes": 5120}, "parent": "render_section",
+"error": None}, and counter events like {"type": "counter", "name":
+"sparql_retries", "value": 1, "attributes": {...}}. "start" is a `time.time()`
+timestamp. Hooks are called from the thread that did the work, so they need to be
+thread-safe when queries run concurrently.
+
+Instrumented spans:
+    "render_dashboard", "get_selector", "render_url", "render_section",
+    "render_template", "write_file", "sparql_request", "resolve_identifiers",
+    "resolve_dois", "export_section".
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+_hooks = []
+_local = threading.local()
+
+
+def add_hook(hook):
+    """
+    Starts sending events to a hook.
+
+    Args:
+        hook (function): A callable taking an event dict.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Stops sending events to a hook added with `add_hook`.
+
+    Args:
+        hook (function): The hook to remove.
+    """
+    _hooks.remove(hook)
+
+
+def enabled():
+    """Returns True if at least one hook is listening."""
+    return bool(_hooks)
+
+
+@contextlib.contextmanager
+def hooked(*hooks):
+    """
+    Adds hooks for the duration of a `with` block.
+
+    Args:
+        *hooks: Callables taking an event dict.
+    """
+    for hook in hooks:
+        add_hook(hook)
+    try:
+        yield
+    finally:
+        for hook in hooks:
+            remove_hook(hook)
+
+
+def _emit(event):
+    for hook in list(_hooks):
+        hook(event)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("name", "attributes", "start", "_started_at", "_parent")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self._parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self.start = time.time()
+        self._started_at = time.perf_counter()
+        return self.attributes
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self._started_at
+        _local.stack.pop()
+        _emit(
+            {
+                "type": "span",
+                "name": self.name,
+                "start": self.start,
+                "seconds": seconds,
+                "attributes": self.attributes,
+                "parent": self._parent,
+                "error": None if exc_type is None else exc_type.__name__,
+            }
+        )
+        return False
+
+
+def span(name, **attributes):
+    """
+    Times a block of code.
+
+    Used as a context manager, it gives the dict of attributes of the span, so
+    that values only known at the end, such as the size of a URL, can be added.
+    When no hook is listening it gives None instead, and nothing is measured:
+
+        with instrumentation.span("render_url") as attributes:
+            url = ...
+            if attributes is not None:
+                attributes["url_bytes"] = len(url)
+
+    Args:
+        name (str): The name of the span.
+        **attributes: Values recorded with the span.
+
+    Returns:
+        A context manager.
+    """
+    if not _hooks:
+        return _NOOP_SPAN
+    return _Span(name, attributes)
+
+
+def traced(name):
+    """
+    A decorator that times every call of a function in a span.
+
+    Args:
+        name (str): The name of the span.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return function(*args, **kwargs)
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1, **attributes):
+    """
+    Adds to a counter.
+
+    Args:
+        name (str): The name of the counter.
+        value (int): The amount to add. Defaults to 1.
+        **attributes: Values recorded with the increment.
+    """
+    if not _hooks:
+        return
+    _emit({"type": "counter", "name": name, "value": value, "attributes": attributes})
+
+
+class LogExporter:
+    """
+    A hook that writes each event as a line of JSON to a logger.
+
+    Args:
+        logger (logging.Logger): The logger to write to. Defaults to the "wbib" logger.
+        level (int): The level of the log records. Defaults to logging.INFO.
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger("wbib")
+        self.level = level
+
+    def __call__(self, event):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps(event, sort_keys=True, default=str))
+
+
+class OpenTelemetryExporter:
+    """
+    A hook that turns spans into OpenTelemetry spans and counters into
+    OpenTelemetry counters. Needs the opentelemetry-api package.
+
+    Args:
+        tracer: An OpenTelemetry tracer. Defaults to the "wbib" tracer of the global
+            tracer provider.
+        meter: An OpenTelemetry meter. Defaults to the "wbib" meter of the global
+            meter provider.
+    """
+
+    def __init__(self, tracer=None, meter=None):
+        if tracer is None or meter is None:
+            from opentelemetry import metrics, trace
+
+            tracer = tracer if tracer is not None else trace.get_tracer("wbib")
+            meter = meter if meter is not None else metrics.get_meter("wbib")
+        self.tracer = tracer
+        self.meter = meter
+        self._counters = {}
+
+    def __call__(self, event):
+        attributes = {
+            key: value if isinstance(value, (bool, int, float, str)) else str(value)
+            for key, value in event["attributes"].items()
+        }
+        if event["type"] == "counter":
+            counter = self._counters.get(event["name"])
+            if counter is None:
+                counter = self._counters[event["name"]] = self.meter.create_counter(
+                    "wbib." + event["name"]
+                )
+            counter.add(event["value"], attributes=attributes)
+            return
+
+        start = int(event["start"] * 1e9)
+        if event["error"] is not None:
+            attributes["error.type"] = event["error"]
+        otel_span = self.tracer.start_span(
+            event["name"], start_time=start, attributes=attributes
+        )
+        otel_span.end(end_time=start + int(event["seconds"] * 1e9))
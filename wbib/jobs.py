@@ -0,0 +1,259 @@
+"""Bulk DOI resolution that survives crashes and timeouts.
+"""
+
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from wbib import dois, identifiers, sparql
+from wbib.wbib import DOI_CHUNK_SIZE, DOI_MAX_WORKERS
+
+
+class DOIResolutionJob:
+    """
+    A DOI -> QID resolution job checkpointed in a SQLite file.
+
+    The DOIs are first registered with `plan`, which de-duplicates them on disk
+    and splits them into numbered chunks. `run` then resolves every chunk that is
+    not done yet, committing the matches of each chunk as soon as it is resolved.
+    Chunks whose query fails are marked as failed and skipped, so a single timeout
+    does not stop the job. Running the job again, in the same process or after a
+    restart, only resolves the failed chunks and those never attempted.
+
+    Args:
+        path (str): The checkpoint file. Use ":memory:" for a job that is not kept.
+        chunk_size (int): The maximum number of DOIs per query. Only used when planning;
+            a job keeps the chunk size it was planned with.
+        max_workers (int): The maximum number of queries running concurrently.
+        endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+        client (wbib.sparql.AsyncSPARQLClient): An optional client to run the queries with.
+            When given, `max_workers` and `endpoint` are taken from the client instead.
+    """
+
+    def __init__(
+        self,
+        path="wbib_job.sqlite",
+        chunk_size=DOI_CHUNK_SIZE,
+        max_workers=DOI_MAX_WORKERS,
+        endpoint=sparql.WDQS_ENDPOINT,
+        client=None,
+    ):
+        if chunk_size < 1:
+            raise ValueError("'chunk_size' needs to be a positive integer")
+        self.path = str(path)
+        self.max_workers = client.max_concurrency if client is not None else max_workers
+        self.endpoint = endpoint
+        self.client = client
+        self._connection = sqlite3.connect(self.path)
+        with self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS dois (
+                    doi TEXT PRIMARY KEY,
+                    chunk INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS dois_chunk ON dois (chunk);
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk INTEGER PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    error TEXT,
+                    finished_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS matches (
+                    doi TEXT NOT NULL,
+                    qid TEXT NOT NULL,
+                    PRIMARY KEY (doi, qid)
+                );
+                """
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('chunk_size', ?)", (chunk_size,)
+            )
+        self.chunk_size = int(self._get_meta("chunk_size"))
+
+    def _get_meta(self, key):
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    @property
+    def planned(self):
+        """True once the DOIs of the job have been registered."""
+        return self._get_meta("planned") is not None
+
+    def plan(self, source, format=None):
+        """
+        Registers the DOIs to resolve. Does nothing if the job was already planned,
+        so the same script can be re-run to resume the job.
+
+        Args:
+            source: A list of DOIs, the path to a file (see `wbib.dois.read_dois`)
+                or an iterable of lines.
+            format (str): The format of `source`. Defaults to a guess from the file name.
+
+        Returns:
+            int: The number of distinct DOIs in the job.
+        """
+        if not self.planned:
+            count = 0
+            with self._connection:
+                for doi in dois.read_dois(source, format):
+                    inserted = self._connection.execute(
+                        "INSERT OR IGNORE INTO dois VALUES (?, ?)",
+                        (doi, count // self.chunk_size),
+                    ).rowcount
+                    count += inserted
+                self._connection.executemany(
+                    "INSERT INTO chunks VALUES (?, 'pending', 0, NULL, NULL)",
+                    ((chunk,) for chunk in range(-(-count // self.chunk_size))),
+                )
+                self._connection.execute("INSERT INTO meta VALUES ('planned', '1')")
+        return self._connection.execute("SELECT COUNT(*) FROM dois").fetchone()[0]
+
+    def status(self):
+        """
+        Counts the chunks of the job per status.
+
+        Returns:
+            dict: The number of chunks "pending", "done" and "failed", and the "total".
+        """
+        counts = {"pending": 0, "done": 0, "failed": 0}
+        for status, count in self._connection.execute(
+            "SELECT status, COUNT(*) FROM chunks GROUP BY status"
+        ):
+            counts[status] = count
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def _resolve_chunk(self, client, chunk_dois):
+        rows = client.iter_rows(identifiers.build_lookup_query(chunk_dois, "doi"))
+        return identifiers.match_rows({doi: [doi] for doi in chunk_dois}, rows)
+
+    def run(self, progress=None):
+        """
+        Resolves every chunk that is not done yet.
+
+        Args:
+            progress (function): Called after each chunk with a dict holding the number
+                of chunks "done", "failed" and in "total", the "seconds" since the run
+                started and the "eta", the estimated seconds left in this run.
+
+        Returns:
+            dict: The status of the job after the run, as returned by `status`.
+        """
+        if not self.planned:
+            raise RuntimeError("The job needs to be planned before it is run")
+
+        todo = [
+            row[0]
+            for row in self._connection.execute(
+                "SELECT chunk FROM chunks WHERE status != 'done' ORDER BY chunk"
+            )
+        ]
+        if self.client is None:
+            with sparql.AsyncSPARQLClient(
+                endpoint=self.endpoint, max_concurrency=self.max_workers
+            ) as client:
+                self._run_chunks(client, todo, progress)
+        else:
+            self._run_chunks(self.client, todo, progress)
+        return self.status()
+
+    def _run_chunks(self, client, todo, progress):
+        started_at = time.perf_counter()
+        finished = 0
+        # Only a couple of chunks per worker are loaded from the checkpoint at a time.
+        batch_size = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as workers:
+            for start in range(0, len(todo), batch_size):
+                futures = {}
+                for chunk in todo[start : start + batch_size]:
+                    chunk_dois = [
+                        row[0]
+                        for row in self._connection.execute(
+                            "SELECT doi FROM dois WHERE chunk = ?", (chunk,)
+                        )
+                    ]
+                    future = workers.submit(self._resolve_chunk, client, chunk_dois)
+                    futures[future] = chunk
+
+                for future in as_completed(futures):
+                    self._finish_chunk(futures[future], future)
+                    finished += 1
+                    if progress is not None:
+                        seconds = time.perf_counter() - started_at
+                        report = self.status()
+                        left = len(todo) - finished
+                        progress(
+                            {
+                                "done": report["done"],
+                                "failed": report["failed"],
+                                "total": report["total"],
+                                "seconds": seconds,
+                                "eta": seconds / finished * left,
+                            }
+                        )
+
+    def _finish_chunk(self, chunk, future):
+        with self._connection:
+            try:
+                pairs = future.result()
+            except Exception as error:
+                self._connection.execute(
+                    """UPDATE chunks SET status = 'failed', attempts = attempts + 1,
+                    error = ?, finished_at = ? WHERE chunk = ?""",
+                    (repr(error), time.time(), chunk),
+                )
+                return
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO matches VALUES (?, ?)", pairs
+            )
+            self._connection.execute(
+                """UPDATE chunks SET status = 'done', attempts = attempts + 1,
+                error = NULL, finished_at = ? WHERE chunk = ?""",
+                (time.time(), chunk),
+            )
+
+    def results(self):
+        """
+        Collects the results of the chunks done so far.
+
+        Returns:
+            dict: The "qids" found, and the DOIs of done chunks that are "missing"
+                on Wikidata, both as sets.
+        """
+        matches = self._connection.execute("SELECT qid FROM matches")
+        qids = set(row[0] for row in matches)
+        missing = set(
+            row[0]
+            for row in self._connection.execute(
+                """SELECT doi FROM dois JOIN chunks USING (chunk)
+                WHERE status = 'done'
+                AND doi NOT IN (SELECT doi FROM matches)"""
+            )
+        )
+        return {"qids": qids, "missing": missing}
+
+    def errors(self):
+        """
+        Lists the failed chunks.
+
+        Returns:
+            dict: The last error of each failed chunk, keyed on the chunk number.
+        """
+        return dict(
+            self._connection.execute(
+                "SELECT chunk, error FROM chunks WHERE status = 'failed'"
+            )
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
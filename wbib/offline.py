@@ -0,0 +1,455 @@
+"""Running the dashboard queries offline, on a local copy of the part of Wikidata
+they read.
+
+A `LocalStore` is filled once with the triples reachable from the selection of a
+dashboard (see `subgraph_queries`), and then answers the queries of every section
+builder in `wbib.queries`, after `translate_query` rewrote the Blazegraph-only
+parts. As it is callable with a query, it can be used as the `executor` of
+`wbib.wbib.render_dashboard` with `materialize=True`:
+
+    store = offline.LocalStore("dashboard.db")
+    store.fetch(qids)
+    wbib.render_dashboard(qids, materialize=True, executor=store)
+
+Needs the pyoxigraph package.
+"""
+
+import re
+from wbib import queries, sparql
+
+# pyoxigraph is imported where it is used, as it is only needed for the offline mode.
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+
+# Links each work of the selection to its selected authors in the local store.
+SELECTION_PREDICATE = "https://github.com/lubianat/wbib#selects"
+
+# Links each selected author to the organizations the "institution_region"
+# restriction of an "advanced" selector selected them through.
+ORGANIZATION_PREDICATE = "https://github.com/lubianat/wbib#selectsThrough"
+
+# Stands for an unbound variable in the emulation of the label service.
+UNBOUND = "https://github.com/lubianat/wbib#unbound"
+
+# Languages of the labels fetched by default.
+LABEL_LANGUAGES = ("en",)
+
+# The prefixes predefined by the Wikidata Query Service that the queries rely on.
+PREFIXES = {
+    "wd": "http://www.wikidata.org/entity/",
+    "wdt": "http://www.wikidata.org/prop/direct/",
+    "wikibase": "http://wikiba.se/ontology#",
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "skos": "http://www.w3.org/2004/02/skos/core#",
+    "schema": "http://schema.org/",
+    "xsd": "http://www.w3.org/2001/XMLSchema#",
+    "bd": "http://www.bigdata.com/rdf#",
+    "p": "http://www.wikidata.org/prop/",
+    "ps": "http://www.wikidata.org/prop/statement/",
+    "pq": "http://www.wikidata.org/prop/qualifier/",
+}
+
+# Statements copied for the works of the selection, for their authors and for their venues.
+WORK_PROPERTIES = ["P50", "P921", "P1433", "P577", "P31", "P1104", "P2093"]
+AUTHOR_PROPERTIES = ["P108", "P463", "P1416", "P496"]
+VENUE_PROPERTIES = ["P921", "P1813"]
+
+# Patterns binding ?entity, from the works of the selection, to the entities whose
+# labels the section queries show.
+LABELLED_ENTITIES = [
+    "BIND(?work AS ?entity)",
+    "?work wdt:P50 | wdt:P921 | wdt:P1433 | wdt:P31 ?entity .",
+    "?work wdt:P1433 / wdt:P921 ?entity .",
+    "?citing_work wdt:P2860 ?work . ?citing_work wdt:P50 | wdt:P921 ?entity .",
+    "?work wdt:P50 / ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?entity .",
+]
+
+_LABEL_SERVICE = re.compile(r"SERVICE\s+wikibase:label\s*\{")
+_HINT = re.compile(r"hint:\w+\s+hint:\w+\s+[^\s.]+\s*\.")
+_INCLUDE = re.compile(r"INCLUDE\s+%(\w+)")
+_WORK_VALUES = re.compile(r"VALUES\s+\?work\s*\{[^}]*\}")
+
+
+def _property_values(properties, prefix="wdt:"):
+    return " ".join(prefix + property_id for property_id in properties)
+
+
+def subgraph_queries(info, mode="basic", languages=LABEL_LANGUAGES):
+    """
+    Builds the CONSTRUCT queries that copy the part of Wikidata read by the section
+    queries: the selection itself (with the organizations its "institution_region"
+    restriction matched, if any), the authors (P50), topics (P921), venues (P1433),
+    dates (P577), types (P31) and citations (P2860) of its works, the affiliations
+    (P108, P463, P1416), ORCIDs (P496) and sitelink counts of their authors, the
+    locations (P625) of their organizations, and the labels of all of those.
+
+    Args:
+        info: Either a dict containing complex information for the selector or a list of QIDs.
+        mode (str): Either "basic" or "advanced".
+        languages (list): The languages of the labels to copy.
+
+    Returns:
+        list: CONSTRUCT queries.
+    """
+    selector = queries.get_selector(info, mode)
+    selection = "{ SELECT DISTINCT ?work ?author WHERE { " + selector + " } }"
+    works = "{ SELECT DISTINCT ?work WHERE { " + selector + " } }"
+    language_list = ", ".join('"{}"'.format(language) for language in languages)
+
+    construct_queries = [
+        "CONSTRUCT {{ ?work <{}> ?author }} WHERE {{ {} }}".format(
+            SELECTION_PREDICATE, selection
+        ),
+        """CONSTRUCT {{ ?work ?property ?value }} WHERE {{
+  {}
+  VALUES ?property {{ {} }}
+  ?work ?property ?value .
+}}""".format(
+            works, _property_values(WORK_PROPERTIES)
+        ),
+        """CONSTRUCT {{ ?citing_work wdt:P2860 ?work . ?citing_work ?property ?value }}
+WHERE {{
+  {}
+  ?citing_work wdt:P2860 ?work .
+  VALUES ?property {{ wdt:P50 wdt:P921 }}
+  ?citing_work ?property ?value .
+}}""".format(
+            works
+        ),
+        """CONSTRUCT {{ ?author ?property ?value }} WHERE {{
+  {}
+  {{ ?work wdt:P50 ?author . }}
+  UNION
+  {{ ?citing_work wdt:P2860 ?work . ?citing_work wdt:P50 ?author . }}
+  VALUES ?property {{ {} wikibase:sitelinks schema:description skos:altLabel }}
+  ?author ?property ?value .
+  FILTER(!isLiteral(?value) || LANG(?value) IN ("", {}))
+}}""".format(
+            works, _property_values(AUTHOR_PROPERTIES), language_list
+        ),
+        """CONSTRUCT {{ ?organization wdt:P361 ?parent . ?organization wdt:P625 ?geo }}
+WHERE {{
+  {}
+  ?work wdt:P50 / ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?organization .
+  {{ ?organization wdt:P361 ?parent . }} UNION {{ ?organization wdt:P625 ?geo . }}
+}}""".format(
+            works
+        ),
+        """CONSTRUCT {{ ?venue ?property ?value }} WHERE {{
+  {}
+  ?work wdt:P1433 ?venue .
+  VALUES ?property {{ {} }}
+  ?venue ?property ?value .
+}}""".format(
+            works, _property_values(VENUE_PROPERTIES)
+        ),
+    ]
+    if mode == "advanced" and "?organization" in selector:
+        construct_queries.append(
+            "CONSTRUCT {{ ?author <{}> ?organization }} WHERE {{ {} }}".format(
+                ORGANIZATION_PREDICATE,
+                "{ SELECT DISTINCT ?author ?organization WHERE { "
+                + selector
+                + " } }",
+            )
+        )
+    for pattern in LABELLED_ENTITIES:
+        construct_queries.append(
+            """CONSTRUCT {{ ?entity rdfs:label ?label }} WHERE {{
+  {}
+  {}
+  ?entity rdfs:label ?label .
+  FILTER(LANG(?label) IN ({}))
+}}""".format(
+                works, pattern, language_list
+            )
+        )
+    return construct_queries
+
+
+def _matching_brace(query, start):
+    """Returns the position of the "}" closing the "{" at `start`."""
+    for position, character, depth in queries._scan_top_level(query[start:]):
+        if character == "}" and depth == 1:
+            return start + position
+    raise ValueError("Unbalanced braces in query")
+
+
+def _translate_label_service(query):
+    """
+    Replaces the label service by OPTIONAL rdfs:label / schema:description patterns
+    that bind the ?xLabel and ?xDescription variables, falling back to the QID as
+    the service does.
+    """
+    match = _LABEL_SERVICE.search(query)
+    if match is None:
+        return query
+    block_end = _matching_brace(query, match.end() - 1)
+    block = query[match.start() : block_end + 1]
+    languages = re.search(r'wikibase:language\s+"([^"]*)"', block).group(1)
+    languages = [
+        "en" if language.strip() == "[AUTO_LANGUAGE]" else language.strip()
+        for language in languages.split(",")
+    ]
+    languages = list(dict.fromkeys(languages))
+
+    query = query[: match.start()] + query[block_end + 1 :]
+    scanned = list(queries._scan_top_level(query))
+    depth = next(d for p, c, d in scanned if p >= match.start())
+    # The patterns go at the end of the group that held the service, and bind the
+    # variables of the SELECT that group belongs to.
+    group_end = next(
+        p for p, c, d in scanned if p >= match.start() and c == "}" and d == depth
+    )
+    group_start = max(
+        p for p, c, d in scanned if p < match.start() and c == "{" and d == depth - 1
+    )
+    select_start = max(
+        (
+            p
+            for p, c, d in scanned
+            if p < group_start and d == depth - 1 and query.startswith("SELECT", p)
+        ),
+        default=0,
+    )
+    scope = query[select_start:group_end]
+
+    labelled = sorted(set(re.findall(r"\?(\w+?)(Label|Description)\b", scope)))
+    patterns = []
+    for variable in sorted(set(variable for variable, suffix in labelled)):
+        if re.search(r"\?" + variable + r"\b", scope):
+            # An unbound variable would match every labelled entity in the OPTIONALs
+            # below, so they use a copy that is never unbound.
+            patterns.append(
+                "BIND(COALESCE(?{0}, <{1}>) AS ?{0}__)".format(variable, UNBOUND)
+            )
+    for variable, suffix in labelled:
+        if not re.search(r"\?" + variable + r"\b", scope):
+            continue
+        predicate = "rdfs:label" if suffix == "Label" else "schema:description"
+        options = []
+        for index, language in enumerate(languages):
+            option = "?{}{}_{}".format(variable, suffix, index)
+            patterns.append(
+                'OPTIONAL {{ ?{}__ {} {} . FILTER(LANG({}) = "{}") }}'.format(
+                    variable, predicate, option, option, language
+                )
+            )
+            options.append(option)
+        if suffix == "Label":
+            options.append(
+                'IF(isIRI(?{0}), STRAFTER(STR(?{0}), "{1}"), STR(?{0}))'.format(
+                    variable, ENTITY_PREFIX
+                )
+            )
+        patterns.append(
+            "BIND(COALESCE({}) AS ?{}{})".format(", ".join(options), variable, suffix)
+        )
+    patterns = "".join("\n    " + pattern for pattern in patterns)
+    return query[:group_end] + patterns + "\n" + query[group_end:]
+
+
+def _drop_aliases_from_group_by(query):
+    """
+    Removes from each GROUP BY the variables that the same SELECT binds with an
+    aggregate, which Blazegraph tolerates but standard SPARQL rejects.
+    """
+    scanned = list(queries._scan_top_level(query))
+    edits = []
+    for index, (position, character, depth) in enumerate(scanned):
+        if character != "S" or not re.match(r"SELECT\b", query[position:]):
+            continue
+        if position > 0 and (query[position - 1].isalnum() or query[position - 1] == "_"):
+            continue
+        group_start = next(
+            p for p, c, d in scanned[index:] if c == "{" and d == depth
+        )
+        group_end = _matching_brace(query, group_start)
+        region_end = next(
+            (p for p, c, d in scanned if p > group_end and c == "}" and d == depth),
+            len(query),
+        )
+        aliases = set(
+            re.findall(r"AS\s+\?(\w+)\s*\)", query[position:group_start], re.I)
+        )
+        group_by = re.compile(r"GROUP\s+BY\s+(.*?)(?=HAVING|ORDER|LIMIT|OFFSET|$)", re.S)
+        match = group_by.search(query, group_end, region_end)
+        if match is None or not aliases:
+            continue
+        keys = [
+            key
+            for key in re.findall(r"\?\w+|\S+", match.group(1))
+            if key[1:] not in aliases
+        ]
+        if len(keys) < len(match.group(1).split()):
+            space = match.group(1)[len(match.group(1).rstrip()) :]
+            replacement = "GROUP BY " + " ".join(keys) + space if keys else ""
+            edits.append((match.start(), match.end(), replacement))
+
+    for start, end, replacement in sorted(edits, reverse=True):
+        query = query[:start] + replacement + query[end:]
+    return query
+
+
+def translate_query(query, use_stored_selection=True):
+    """
+    Rewrites a query built for the Wikidata Query Service into standard SPARQL 1.1.
+
+    Named subqueries (`WITH { ... } AS %name` and `INCLUDE %name`) are inlined as
+    subqueries, the label service is replaced by label patterns, query hints are
+    dropped, and the prefixes predefined by the service are declared.
+
+    Args:
+        query (str): A query built by one of the builders in `wbib.queries`.
+        use_stored_selection (bool): Replace the %selection subquery by the selection
+            stored by `LocalStore.fetch`, instead of evaluating the selector locally.
+            Defaults to True.
+
+    Returns:
+        str: The translated query.
+    """
+    projection, named_subqueries, rest = queries._split_query(query.strip())
+
+    bodies = {}
+
+    def include(text):
+        return _INCLUDE.sub(lambda match: bodies[match.group(1)], text)
+
+    for name, subquery in named_subqueries:
+        if name == "selection" and use_stored_selection:
+            # The works listed by the selector are kept, so that shards stay apart.
+            values = _WORK_VALUES.search(subquery)
+            variables = "?work ?author"
+            patterns = "?work <{}> ?author .".format(SELECTION_PREDICATE)
+            if "?organization" in subquery:
+                variables += " ?organization"
+                patterns += " ?author <{}> ?organization .".format(
+                    ORGANIZATION_PREDICATE
+                )
+            bodies[name] = "{{ SELECT DISTINCT {} WHERE {{ {} {} }} }}".format(
+                variables, values.group(0) if values else "", patterns
+            )
+        else:
+            bodies[name] = include(subquery.strip()[len("WITH") :].strip())
+
+    query = include(projection + rest)
+    query = _HINT.sub("", query)
+    while _LABEL_SERVICE.search(query):
+        query = _translate_label_service(query)
+    query = _drop_aliases_from_group_by(query)
+    prefixes = "".join(
+        "PREFIX {}: <{}>\n".format(prefix, iri) for prefix, iri in PREFIXES.items()
+    )
+    return prefixes + query
+
+
+def _term_to_json(term):
+    from pyoxigraph import BlankNode, Literal
+
+    if isinstance(term, Literal):
+        value = {"type": "literal", "value": term.value}
+        if term.language:
+            value["xml:lang"] = term.language
+        elif term.datatype.value != PREFIXES["xsd"] + "string":
+            value["datatype"] = term.datatype.value
+        return value
+    if isinstance(term, BlankNode):
+        return {"type": "bnode", "value": term.value}
+    return {"type": "uri", "value": term.value}
+
+
+class LocalStore:
+    """
+    An embedded SPARQL store holding a scoped copy of Wikidata.
+
+    Args:
+        path (str): The directory of the on-disk store, reused across runs.
+            Defaults to None (an in-memory store).
+    """
+
+    def __init__(self, path=None):
+        from pyoxigraph import Store
+
+        self.path = path
+        self._store = Store(path) if path is not None else Store()
+
+    def load(self, data, media_type="text/turtle"):
+        """
+        Adds triples to the store.
+
+        Args:
+            data (bytes): The serialized triples.
+            media_type (str): Their format, such as "text/turtle" or "application/n-triples".
+        """
+        from pyoxigraph import RdfFormat
+
+        self._store.load(data, format=RdfFormat.from_media_type(media_type))
+
+    def fetch(
+        self,
+        info,
+        mode="basic",
+        client=None,
+        endpoint=sparql.WDQS_ENDPOINT,
+        languages=LABEL_LANGUAGES,
+    ):
+        """
+        Copies the triples read by the section queries from a SPARQL endpoint.
+        See `subgraph_queries`.
+
+        Args:
+            info: Either a dict containing complex information for the selector or a list of QIDs.
+            mode (str): Either "basic" or "advanced".
+            client (wbib.sparql.AsyncSPARQLClient): An optional client to run the queries
+                with. When given, `endpoint` is taken from the client instead.
+            endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+            languages (list): The languages of the labels to copy.
+
+        Returns:
+            int: The number of triples in the store afterwards.
+        """
+        construct_queries = subgraph_queries(info, mode, languages)
+        if client is None:
+            with sparql.AsyncSPARQLClient(endpoint=endpoint) as own_client:
+                documents = own_client.run_raw(construct_queries, "text/turtle")
+        else:
+            documents = client.run_raw(construct_queries, "text/turtle")
+        for document in documents:
+            self.load(document)
+        return len(self)
+
+    def query(self, query, translate=True):
+        """
+        Runs a SELECT query on the store.
+
+        Args:
+            query (str): A query built by one of the builders in `wbib.queries`.
+            translate (bool): Rewrite the query with `translate_query` first.
+                Defaults to True.
+
+        Returns:
+            dict: The SPARQL JSON results.
+        """
+        if translate:
+            query = translate_query(query)
+        solutions = self._store.query(query)
+        variables = [variable.value for variable in solutions.variables]
+        bindings = []
+        for solution in solutions:
+            binding = {}
+            for variable in variables:
+                term = solution[variable]
+                if term is not None:
+                    binding[variable] = _term_to_json(term)
+            bindings.append(binding)
+        return {"head": {"vars": variables}, "results": {"bindings": bindings}}
+
+    def __call__(self, query):
+        return self.query(query)
+
+    def __len__(self):
+        return len(self._store)
+
+    def flush(self):
+        """Writes pending changes of an on-disk store to disk."""
+        self._store.flush()
@@ -0,0 +1,118 @@
+"""A compact representation for large sets of Wikidata QIDs.
+"""
+
+import bisect
+from array import array
+
+_WRITE_BLOCK_SIZE = 4096
+
+
+def _to_int(qid):
+    if isinstance(qid, int):
+        return qid
+    if qid[:1] in ("Q", "q") and qid[1:].isdigit():
+        return int(qid[1:])
+    raise ValueError("'{}' is not a valid QID".format(qid))
+
+
+class QIDSet:
+    """
+    An immutable, sorted and de-duplicated set of QIDs, stored as unsigned integers
+    in an array instead of one Python string per QID.
+
+    Iterating over it yields "Q..." strings, so it can be used anywhere a list of QIDs
+    is expected, such as the `info` argument of the query builders in "basic" mode.
+
+    Args:
+        qids (iterable): QIDs as "Q..." strings or as integers.
+
+    Raises:
+        ValueError: If an element is not a valid QID.
+    """
+
+    __slots__ = ("_ids", "_hash")
+
+    def __init__(self, qids=()):
+        if isinstance(qids, QIDSet):
+            self._ids = qids._ids
+        else:
+            self._ids = array("Q", sorted(set(_to_int(qid) for qid in qids)))
+        self._hash = None
+
+    @classmethod
+    def _from_array(cls, ids):
+        qid_set = cls.__new__(cls)
+        qid_set._ids = ids
+        qid_set._hash = None
+        return qid_set
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for numeric_id in self._ids:
+            yield "Q{}".format(numeric_id)
+
+    def __contains__(self, qid):
+        try:
+            numeric_id = _to_int(qid)
+        except (TypeError, ValueError):
+            return False
+        position = bisect.bisect_left(self._ids, numeric_id)
+        return position < len(self._ids) and self._ids[position] == numeric_id
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return QIDSet._from_array(self._ids[index])
+        return "Q{}".format(self._ids[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, QIDSet):
+            return NotImplemented
+        return self._ids == other._ids
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self._ids.tobytes())
+        return self._hash
+
+    def __repr__(self):
+        return "QIDSet(<{} QIDs>)".format(len(self))
+
+    def split(self, number_of_parts):
+        """
+        Splits the set into contiguous parts of nearly equal size.
+
+        Args:
+            number_of_parts (int): The number of parts.
+
+        Returns:
+            list: A list of QIDSet objects, none of them empty.
+        """
+        size, remainder = divmod(len(self), number_of_parts)
+        parts = []
+        start = 0
+        for part in range(number_of_parts):
+            end = start + size + (1 if part < remainder else 0)
+            if end > start:
+                parts.append(self[start:end])
+            start = end
+        return parts
+
+    def write_values(self, out, prefix="wd:"):
+        """
+        Writes the QIDs as a SPARQL VALUES block, a block of QIDs at a time.
+
+        Args:
+            out: A file-like object with a `write` method, such as `io.StringIO`.
+            prefix (str): The prefix written before each QID.
+        """
+        out.write("{ ")
+        # Written in blocks, so that only a few thousand QID strings exist at a time.
+        template = prefix + "Q{}"
+        for start in range(0, len(self._ids), _WRITE_BLOCK_SIZE):
+            if start:
+                out.write(" ")
+            block = self._ids[start : start + _WRITE_BLOCK_SIZE]
+            out.write(" ".join(map(template.format, block)))
+        out.write(" }")
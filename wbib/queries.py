@@ -1,7 +1,186 @@
+import functools
+import io
+import re
 import urllib.parse
+from wbib import instrumentation, sparql
+from wbib.qids import QIDSet
+
+# Prefix of the URLs that embed a query; the encoded query is appended to it.
+EMBED_URL = "https://query.wikidata.org/embed.html#"
+
+# Maximum number of selectors and of URLs (per query builder) kept in memory.
+# `wbib.wbib.render_dashboard` empties these caches once a dashboard's sections are
+# rendered, so that URLs of large dashboards do not pile up across a batch.
+QUERY_CACHE_SIZE = 128
+
+# Restrictions of the advanced mode, from the one expected to select the fewest
+# authors and works to the one expected to select the most.
+RESTRICTION_SELECTIVITY = [
+    "author_is_topic_of",
+    "event",
+    "topic_of_work",
+    "author_area",
+    "institution_region",
+    "gender",
+]
+
+# Property paths pre-expanded by optimize_restrictions, per restriction.
+RESTRICTION_CLOSURES = {
+    "topic_of_work": "wdt:P279*",
+    "institution_region": "wdt:P361*",
+}
+
+_cached_builders = []
+_closure_cache = {}
+
+
+def canonicalize_info(info, mode="advanced"):
+    """
+    Reduces the info given to the query builders to a hashable form, in which
+    equivalent inputs compare equal.
+
+    Args:
+        info: either a dict containing complex information for the selector or a list of QIDs
+        mode: a string representing the mode. Defaults to "advanced".
+
+    Returns:
+        tuple: In "advanced" mode, the sorted (restriction, QIDs) pairs. In "basic" mode,
+            a QIDSet with the sorted unique QIDs.
+    """
+    if mode == "advanced":
+        return tuple(
+            sorted(
+                (key, _freeze_restriction(value))
+                for key, value in info["restriction"].items()
+            )
+        )
+    return QIDSet(info)
+
+
+def _freeze_restriction(value):
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    return tuple(sorted(set(value)))
+
+
+def _info_from_canonical(key, mode):
+    if mode == "advanced":
+        return {
+            "restriction": {
+                name: list(value) if isinstance(value, tuple) else value
+                for name, value in key
+            }
+        }
+    return key
+
+
+def cached_query_url(builder):
+    """
+    Decorator that memoizes a query builder on the canonical form of its info.
+
+    The cache keeps up to QUERY_CACHE_SIZE URLs per builder and is emptied by
+    `clear_query_cache`.
+    """
+
+    @functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+    def cached_builder(key, mode, embed_url):
+        return builder(_info_from_canonical(key, mode), mode, embed_url=embed_url)
+
+    @functools.wraps(builder)
+    def wrapper(info, mode="basic", embed_url=EMBED_URL):
+        return cached_builder(canonicalize_info(info, mode), mode, embed_url)
+
+    _cached_builders.append(cached_builder)
+    return wrapper
+
+
+def clear_query_cache(closures=True):
+    """
+    Empties the caches of selectors and query URLs.
+
+    Args:
+        closures (bool): If False, the closures from `expand_closure`, which are small
+            and often shared by the dashboards of a batch, are kept. Defaults to True.
+    """
+    _get_cached_selector.cache_clear()
+    if closures:
+        _closure_cache.clear()
+    for cached_builder in _cached_builders:
+        cached_builder.cache_clear()
+
+
+def expand_closure(qids, path, executor=None):
+    """
+    Lists every item linked to the given QIDs through a property path, such as all the
+    subclasses of a topic. Results are cached until `clear_query_cache` is called.
+
+    Args:
+        qids (list): The QIDs at the end of the path.
+        path (str): A SPARQL property path, such as "wdt:P279*".
+        executor (function): Takes a SPARQL query and returns the SPARQL JSON results.
+            Defaults to `wbib.sparql.perform_query` on the public WDQS.
+
+    Returns:
+        list: The sorted QIDs of the items found, including the given ones for "*" paths.
+    """
+    key = (tuple(sorted(set(qids))), path)
+    if key not in _closure_cache:
+        if executor is None:
+            executor = sparql.perform_query
+        query = (
+            """SELECT DISTINCT ?item WHERE {
+  VALUES ?root """
+            + format_with_prefix(key[0])
+            + """
+  ?item """
+            + path
+            + """ ?root .
+}"""
+        )
+        result = executor(query)
+        _closure_cache[key] = sorted(
+            binding["item"]["value"].rsplit("/", 1)[-1]
+            for binding in result["results"]["bindings"]
+        )
+    return _closure_cache[key]
+
+
+def optimize_restrictions(info, executor=None):
+    """
+    Prepares an advanced-mode config for a faster selector.
+
+    The subclass closure of "topic_of_work" and the part-of closure of
+    "institution_region" are queried once and stored as plain lists of QIDs, so the
+    selector matches them with VALUES instead of property paths. The selector also
+    starts with the most selective restriction (see RESTRICTION_SELECTIVITY) and
+    hints the query planner to run it first.
+
+    Args:
+        info (dict): A config in the format of the advanced mode yaml file.
+        executor (function): Takes a SPARQL query and returns the SPARQL JSON results.
+            Defaults to `wbib.sparql.perform_query` on the public WDQS.
+
+    Returns:
+        dict: A copy of `info` with the expanded restrictions.
+    """
+    restriction = dict(info["restriction"])
+    for name, path in RESTRICTION_CLOSURES.items():
+        if restriction.get(name) is not None:
+            restriction[name + "_closure"] = expand_closure(
+                restriction[name], path, executor
+            )
+    restriction["optimized"] = True
+
+    optimized_info = dict(info)
+    optimized_info["restriction"] = restriction
+    return optimized_info
 
 
 def format_with_prefix(list_of_qids):
+    if isinstance(list_of_qids, QIDSet):
+        out = io.StringIO()
+        list_of_qids.write_values(out)
+        return out.getvalue()
 
     list_with_prefix = ["wd:" + i for i in list_of_qids]
     return "{ " + " ".join(list_with_prefix) + " }"
@@ -16,70 +195,119 @@ def get_selector(info, mode="advanced"):
 
     Args:
         info: either a dict containing complex information for the selector or a list of QIDs
+          (or a wbib.qids.QIDSet)
         mode: a string representing the mode. If "advanced", then a config is expected for the
           info parameters. If "basic", a list of QIDs is expected. Defaults to "advanced".
 
+    Selectors are cached on the canonical form of `info` (see `canonicalize_info`),
+    so QIDs in "basic" mode end up sorted and de-duplicated.
     """
 
+    with instrumentation.span("get_selector", mode=mode) as attributes:
+        if attributes is not None and mode == "basic":
+            attributes["qids"] = len(info)
+        return _get_cached_selector(canonicalize_info(info, mode), mode)
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _get_cached_selector(key, mode):
+    info = _info_from_canonical(key, mode)
+
     if mode == "advanced":
-        fields_of_work = info["restriction"]["author_area"]
+        restriction = info["restriction"]
+        restriction_selectors = []
+
+        fields_of_work = restriction["author_area"]
 
         if fields_of_work is not None:
-            field_of_work_selector = (
-                """
+            restriction_selectors.append(
+                (
+                    "author_area",
+                    """
                 VALUES ?field_of_work """
-                + format_with_prefix(fields_of_work)
-                + """
+                    + format_with_prefix(fields_of_work)
+                    + """
                 ?author wdt:P101 ?field_of_work.
-                """
+                """,
+                )
             )
-        else:
-            field_of_work_selector = ""
 
-        topic_of_work = info["restriction"]["topic_of_work"]
+        topic_of_work = restriction["topic_of_work"]
+        topic_closure = restriction.get("topic_of_work_closure")
 
-        if topic_of_work is not None:
-            topic_of_work_selector = (
-                """
+        if topic_closure is not None:
+            # Subclasses were expanded beforehand by optimize_restrictions.
+            restriction_selectors.append(
+                (
+                    "topic_of_work",
+                    """
+                VALUES ?topics """
+                    + format_with_prefix(topic_closure)
+                    + """
+                ?work wdt:P921 ?topics.
+                """,
+                )
+            )
+        elif topic_of_work is not None:
+            restriction_selectors.append(
+                (
+                    "topic_of_work",
+                    """
                 VALUES ?topics """
-                + format_with_prefix(topic_of_work)
-                + """
+                    + format_with_prefix(topic_of_work)
+                    + """
                 ?work wdt:P921/wdt:P279* ?topics.
-                """
+                """,
+                )
             )
-        else:
-            topic_of_work_selector = ""
 
-        region = info["restriction"]["institution_region"]
-
-        if region is not None:
-            region_selector = (
-                """
+        region = restriction["institution_region"]
+        region_closure = restriction.get("institution_region_closure")
+
+        if region_closure is not None:
+            # Parts of the regions were expanded beforehand by optimize_restrictions.
+            restriction_selectors.append(
+                (
+                    "institution_region",
+                    """
+                VALUES ?country """
+                    + format_with_prefix(region_closure)
+                    + """
+                ?author ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?organization . 
+                ?organization wdt:P17 ?country.
+                """,
+                )
+            )
+        elif region is not None:
+            restriction_selectors.append(
+                (
+                    "institution_region",
+                    """
                 VALUES ?regions """
-                + format_with_prefix(region)
-                + """
+                    + format_with_prefix(region)
+                    + """
                 ?country wdt:P361* ?regions.
                 ?author ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?organization . 
                 ?organization wdt:P17 ?country.
-                """
+                """,
+                )
             )
-        else:
-            region_selector = ""
 
-        gender = info["restriction"]["gender"]
+        gender = restriction["gender"]
         if gender is not None:
-            gender_selector = (
-                """
+            restriction_selectors.append(
+                (
+                    "gender",
+                    """
                 VALUES ?gender """
-                + format_with_prefix(gender)
-                + """
+                    + format_with_prefix(gender)
+                    + """
                 ?author wdt:P21 ?gender.
-                """
+                """,
+                )
             )
-        else:
-            gender_selector = ""
 
-        event = info["restriction"]["event"]
+        event = restriction["event"]
 
         if event is not None:
 
@@ -87,55 +315,308 @@ def get_selector(info, mode="advanced"):
             # P664 - organizer
             # P1334 - has participant
             # ^P710 - inverse of (participated in)
-            event_selector = (
-                """
+            restriction_selectors.append(
+                (
+                    "event",
+                    """
                 VALUES ?event """
-                + format_with_prefix(event)
-                + """
+                    + format_with_prefix(event)
+                    + """
                 ?event wdt:P823 |  wdt:P664 | wdt:P1344 | ^wdt:P710 ?author.
-                """
+                """,
+                )
             )
-        else:
-            event_selector = ""
 
-        author_is_topic_of = info["restriction"]["author_is_topic_of"]
+        author_is_topic_of = restriction["author_is_topic_of"]
 
         if author_is_topic_of is not None:
-            author_is_topic_of_selector = (
-                """
+            restriction_selectors.append(
+                (
+                    "author_is_topic_of",
+                    """
                 VALUES ?biographical_work """
-                + format_with_prefix(author_is_topic_of)
-                + """
+                    + format_with_prefix(author_is_topic_of)
+                    + """
                 ?biographical_work wdt:P921 ?author.
-                """
+                """,
+                )
             )
-        else:
-            author_is_topic_of_selector = ""
-
-        selector = (
-            field_of_work_selector
-            + topic_of_work_selector
-            + region_selector
-            + gender_selector
-            + event_selector
-            + author_is_topic_of_selector
-            + """
+
+        author_selector = """
             ?work wdt:P50 ?author.
             """
-        )
+
+        if restriction.get("optimized") and restriction_selectors:
+            # Most selective restriction first, joined to the works right away.
+            restriction_selectors.sort(
+                key=lambda item: RESTRICTION_SELECTIVITY.index(item[0])
+            )
+            selectors = [selector for _, selector in restriction_selectors]
+            selector = (
+                selectors[0]
+                + """hint:Prior hint:runFirst true .
+                """
+                + author_selector
+                + "".join(selectors[1:])
+            )
+        else:
+            selector = (
+                "".join(selector for _, selector in restriction_selectors)
+                + author_selector
+            )
     else:
-        selector = f"""
-        VALUES ?work {format_with_prefix(info)} .
-        ?work wdt:P50 ?author .
-        """
+        # info is a QIDSet here, so the VALUES block is streamed into the selector.
+        out = io.StringIO()
+        out.write("\n        VALUES ?work ")
+        info.write_values(out)
+        out.write(" .\n        ?work wdt:P50 ?author .\n        ")
+        selector = out.getvalue()
     return selector
 
 
-def render_url(query):
-    return "https://query.wikidata.org/embed.html#" + urllib.parse.quote(query, safe="")
+def get_selection_subquery(info, mode="advanced"):
+    """
+    Wraps the selector in a named subquery, %selection, so that the rest of a query
+    can reuse it with `INCLUDE %selection`.
 
+    In "basic" mode, it binds each ?work and ?author pair once. In "advanced" mode, it
+    keeps every variable and every solution of the selector, as if the selector was
+    written in the query itself: the map of institutions joins on the ?organization
+    of the "institution_region" restriction, and counts are not changed.
 
-def get_query_url_for_author_without_affiliation(info, mode="basic"):
+    Args:
+        info: either a dict containing complex information for the selector or a list of QIDs
+        mode: a string representing the mode. Defaults to "advanced".
+
+    Returns:
+        str: A "WITH { ... } AS %selection" clause.
+    """
+    projection = "DISTINCT ?work ?author" if mode == "basic" else "*"
+    return (
+        """
+  WITH {
+    SELECT """
+        + projection
+        + """ WHERE {
+    """
+        + get_selector(info, mode)
+        + """
+    }
+  } AS %selection
+  """
+    )
+
+
+def _scan_top_level(query):
+    """
+    Yields (position, character, depth) for the characters of a query that are
+    outside of comments, strings and IRIs, with the brace depth before each one.
+    """
+    depth = 0
+    position = 0
+    while position < len(query):
+        character = query[position]
+        if character == "#":
+            end = query.find("\n", position)
+            position = len(query) if end == -1 else end
+            continue
+        if character in "\"'":
+            end = query.find(character, position + 1)
+            position = len(query) if end == -1 else end + 1
+            continue
+        if character == "<" and re.match(r"<[^\s<>]*>", query[position:]):
+            position = query.index(">", position) + 1
+            continue
+        yield position, character, depth
+        if character == "{":
+            depth += 1
+        elif character == "}":
+            depth -= 1
+        position += 1
+
+
+def _split_query(query):
+    """
+    Splits a SELECT query into its projection ("SELECT ..."), its named subqueries
+    as (name, "WITH { ... }") pairs, and the rest ("WHERE { ... }" and modifiers).
+    """
+    keywords = []
+    block_start = None
+    for position, character, depth in _scan_top_level(query):
+        if depth != 0:
+            continue
+        if character == "{" and block_start is None:
+            block_start = position
+        if character in "WH" and re.match(r"(WITH|WHERE)\s*\{", query[position:]):
+            if position == 0 or not (
+                query[position - 1].isalnum() or query[position - 1] == "_"
+            ):
+                keywords.append(position)
+
+    projection_end = keywords[0] if keywords else block_start
+    projection = query[:projection_end]
+    named_subqueries = []
+    position = projection_end
+    while query.startswith("WITH", position):
+        block_end = None
+        for block_position, character, depth in _scan_top_level(query[position:]):
+            if character == "}" and depth == 1:
+                block_end = position + block_position + 1
+                break
+        match = re.match(r"\s*AS\s+%(\w+)\s*", query[block_end:])
+        named_subqueries.append((match.group(1), query[position:block_end]))
+        position = block_end + match.end()
+    return projection, named_subqueries, query[position:]
+
+
+def _projection_variables(projection):
+    """Lists the names of the variables projected by a "SELECT ..." clause."""
+    projection = re.sub(r"#[^\n]*", "", projection)
+    projection = re.sub(r"\"[^\"]*\"|'[^']*'", "''", projection)
+    projection = re.sub(r"^\s*SELECT\s+(DISTINCT\s+|REDUCED\s+)?", "", projection)
+    variables = []
+    depth = 0
+    expression_start = 0
+    for position, character in enumerate(projection):
+        if character == "(":
+            if depth == 0:
+                expression_start = position
+            depth += 1
+        elif character == ")":
+            depth -= 1
+            if depth == 0:
+                expression = projection[expression_start : position + 1]
+                variables.append(
+                    re.search(r"AS\s+\?(\w+)\s*\)$", expression, re.I).group(1)
+                )
+        elif character == "?" and depth == 0:
+            variables.append(re.match(r"\?(\w+)", projection[position:]).group(1))
+    return variables
+
+
+def combine_queries(named_queries):
+    """
+    Combines several section queries into a single query, so that the endpoint
+    evaluates the shared %selection subquery only once for all of them.
+
+    Each query becomes one branch of a UNION and binds ?section to its name. Named
+    subqueries are renamed per section, except %selection when it is the same in all
+    queries. Use `split_combined_results` to get the results of each section back.
+
+    Args:
+        named_queries (list): (name, query) pairs, for example the section names and
+            their SPARQL queries.
+
+    Returns:
+        str: The combined SPARQL query.
+    """
+    shared_selection = None
+    named_subqueries = []
+    branches = []
+    for index, (name, query) in enumerate(named_queries):
+        projection, subqueries, rest = _split_query(query.strip())
+        renames = {}
+        for subquery_name, subquery in subqueries:
+            if subquery_name == "selection" and shared_selection in (None, subquery):
+                if shared_selection is None:
+                    shared_selection = subquery
+                    named_subqueries.append(subquery + " AS %selection")
+                continue
+            renames[subquery_name] = "{}_{}".format(subquery_name, index)
+
+        def rename(text):
+            for old_name, new_name in renames.items():
+                text = re.sub(r"%" + old_name + r"(?!\w)", "%" + new_name, text)
+            return text
+
+        for subquery_name, subquery in subqueries:
+            if subquery_name in renames:
+                named_subqueries.append(
+                    rename(subquery) + " AS %" + renames[subquery_name]
+                )
+        section_binding = '("{}" AS ?section)'.format(name.replace('"', '\\"'))
+        branch = re.sub(
+            r"\bSELECT\b", "SELECT " + section_binding, rename(projection), count=1
+        )
+        branches.append("  {\n" + branch + rename(rest) + "\n  }")
+
+    return (
+        "SELECT *\n"
+        + "\n".join(named_subqueries)
+        + "\nWHERE {\n"
+        + "\n  UNION\n".join(branches)
+        + "\n}"
+    )
+
+
+def split_combined_results(result, named_queries):
+    """
+    Fans out the results of a query built by `combine_queries` into the results
+    of each section. The order of the rows within a section is not guaranteed to
+    match the order of the standalone query.
+
+    Args:
+        result (dict): The SPARQL JSON results of the combined query.
+        named_queries (list): The (name, query) pairs given to `combine_queries`.
+
+    Returns:
+        dict: The SPARQL JSON results of each section, keyed on the section name.
+    """
+    split_results = {}
+    for name, query in named_queries:
+        projection = _split_query(query.strip())[0]
+        split_results[name] = {
+            "head": {"vars": _projection_variables(projection)},
+            "results": {"bindings": []},
+        }
+    for binding in result["results"]["bindings"]:
+        binding = dict(binding)
+        name = binding.pop("section")["value"]
+        split_results[name]["results"]["bindings"].append(binding)
+    return split_results
+
+
+def render_url(query, embed_url=EMBED_URL):
+    """
+    Encodes a query into a URL that embeds its results.
+
+    Args:
+        query (str): A SPARQL query.
+        embed_url (str): The prefix of the URL, such as the embed page of a mirror of
+            WDQS. Defaults to EMBED_URL, the embed page of the public WDQS.
+
+    Returns:
+        str: The URL.
+    """
+    with instrumentation.span("render_url") as attributes:
+        url = embed_url + urllib.parse.quote(query, safe="")
+        if attributes is not None:
+            attributes["query_bytes"] = len(query.encode("utf-8"))
+            attributes["url_bytes"] = len(url)
+    return url
+
+
+def query_from_url(url, embed_url=None):
+    """
+    Recovers the SPARQL query from a URL built by `render_url`.
+
+    Args:
+        url (str): An embed URL.
+        embed_url (str): The prefix the URL was built with. Defaults to None, in which
+            case the encoded query is taken to follow the "#", as in EMBED_URL.
+
+    Returns:
+        str: The SPARQL query.
+    """
+    if embed_url is not None and url.startswith(embed_url):
+        return urllib.parse.unquote(url[len(embed_url) :])
+    return urllib.parse.unquote(url.split("#", 1)[1])
+
+
+@cached_query_url
+def get_query_url_for_author_without_affiliation(
+    info, mode="basic", embed_url=EMBED_URL
+):
     query = (
         """
 # tool: scholia
@@ -145,11 +626,12 @@ SELECT
   (SAMPLE(?wikis_) AS ?wikis)
   ?author ?authorLabel ?authorDescription
   (SAMPLE(?orcid_) AS ?orcid)
-WITH {
-  SELECT DISTINCT ?author WHERE {
 """
-        + get_selector(info, mode)
+        + get_selection_subquery(info, mode)
         + """
+WITH {
+  SELECT DISTINCT ?author WHERE {
+    INCLUDE %selection
     
     MINUS {?author ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?organization .}
   } 
@@ -177,10 +659,11 @@ ORDER BY DESC(?works)
   """
     )
 
-    return render_url(query)
+    return render_url(query, embed_url)
 
 
-def get_query_url_for_missing_author_items(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_missing_author_items(info, mode="basic", embed_url=EMBED_URL):
     query = (
         """
   #defaultView:Table
@@ -190,12 +673,13 @@ def get_query_url_for_missing_author_items(info, mode="basic"):
     (URI(CONCAT(
         'https://author-disambiguator.toolforge.org/names_oauth.php?doit=Look+for+author&name=',
         ENCODE_FOR_URI(?author_name))) AS ?author_resolver_url)
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WHERE {
     {
       SELECT DISTINCT ?author_name {
-    """
-        + get_selector(info, mode)
-        + """
+        INCLUDE %selection
         ?work wdt:P50 ?author . 
         ?author skos:altLabel | rdfs:label ?author_name_ .
         
@@ -213,10 +697,11 @@ def get_query_url_for_missing_author_items(info, mode="basic"):
   """
     )
 
-    return render_url(query)
+    return render_url(query, embed_url)
 
 
-def get_query_url_for_articles(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_articles(info, mode="basic", embed_url=EMBED_URL):
     query = (
         """
   SELECT
@@ -226,10 +711,11 @@ def get_query_url_for_articles(info, mode="basic"):
   (SAMPLE(?pages_) AS ?pages)
   ?venue ?venueLabel
   (GROUP_CONCAT(DISTINCT ?author_label; separator=", ") AS ?authors)
-  WHERE {
 """
-        + get_selector(info, mode)
+        + get_selection_subquery(info, mode)
         + """
+  WHERE {
+  INCLUDE %selection
   ?work wdt:P50 ?author_all .
   OPTIONAL {
     ?author rdfs:label ?author_label_ . FILTER (LANG(?author_label_) = 'en')
@@ -248,16 +734,20 @@ def get_query_url_for_articles(info, mode="basic"):
   """
     )
 
-    return render_url(query)
+    return render_url(query, embed_url)
 
 
-def get_query_url_for_topic_bubble(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_topic_bubble(info, mode="basic", embed_url=EMBED_URL):
 
     query = (
         """
 
   #defaultView:BubbleChart
   SELECT ?score ?topic ?topicLabel
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WITH {
     SELECT
       (SUM(?score_) AS ?score)
@@ -265,18 +755,14 @@ def get_query_url_for_topic_bubble(info, mode="basic"):
     WHERE {
           {
         SELECT (100 AS ?score_) ?topic WHERE {
-        """
-        + get_selector(info, mode)
-        + """
+          INCLUDE %selection
           ?work  wdt:P921 ?topic . 
         }
       }
       UNION
       {
         SELECT (1 AS ?score_) ?topic WHERE {
-        """
-        + get_selector(info, mode)
-        + """
+          INCLUDE %selection
           ?citing_work wdt:P2860 ?work .
           ?citing_work wdt:P921 ?topic . 
         }
@@ -293,20 +779,22 @@ def get_query_url_for_topic_bubble(info, mode="basic"):
 
   """
     )
-    return render_url(query)
+    return render_url(query, embed_url)
 
 
-def get_topics_as_table(info, mode="basic"):
+@cached_query_url
+def get_topics_as_table(info, mode="basic", embed_url=EMBED_URL):
     query_3 = (
         """
   #defaultView:Table
   SELECT ?count ?theme ?themeLabel ?example_work ?example_workLabel
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WITH {
     SELECT (COUNT(?work) AS ?count) ?theme (SAMPLE(?work) AS ?example_work)
     WHERE {
-    """
-        + get_selector(info, mode)
-        + """
+      INCLUDE %selection
       ?work wdt:P921 ?theme .
     }
     GROUP BY ?theme
@@ -319,10 +807,11 @@ def get_topics_as_table(info, mode="basic"):
 
   """
     )
-    return render_url(query_3)
+    return render_url(query_3, embed_url)
 
 
-def get_query_url_for_venues(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_venues(info, mode="basic", embed_url=EMBED_URL):
     query_4 = (
         """
 
@@ -332,15 +821,16 @@ def get_query_url_for_venues(info, mode="basic"):
     ?count (SAMPLE(?short_name_) AS ?short_name)
     ?venue ?venueLabel
     ?topics ?topicsUrl
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WITH {
     SELECT
       (COUNT(DISTINCT ?work) as ?count)
       ?venue
       (GROUP_CONCAT(DISTINCT ?topic_label; separator=", ") AS ?topics)
     WHERE {
-    """
-        + get_selector(info, mode)
-        + """
+      INCLUDE %selection
       ?work wdt:P1433 ?venue .
       OPTIONAL {
         ?venue wdt:P921 ?topic .
@@ -358,10 +848,11 @@ def get_query_url_for_venues(info, mode="basic"):
 
   """
     )
-    return render_url(query_4)
+    return render_url(query_4, embed_url)
 
 
-def get_query_url_for_locations(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_locations(info, mode="basic", embed_url=EMBED_URL):
     query_5 = (
         """
 #defaultView:Map
@@ -372,15 +863,16 @@ SELECT
 ?sample_author ?sample_authorLabel
 ?sample_work  ?sample_workLabel
 
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WITH {
     SELECT DISTINCT ?organization ?geo 
     (COUNT(DISTINCT ?work) AS ?count) 
     (SAMPLE(?work) as ?sample_work) 
     (SAMPLE(?author) as ?sample_author) WHERE {
 
-    """
-        + get_selector(info, mode)
-        + """
+          INCLUDE %selection
           ?work wdt:P50 ?author .
       ?author ( wdt:P108 | wdt:P463 | wdt:P1416 ) / wdt:P361* ?organization . 
       ?organization wdt:P625 ?geo .
@@ -399,10 +891,11 @@ SELECT
 
   """
     )
-    return render_url(query_5)
+    return render_url(query_5, embed_url)
 
 
-def get_query_url_for_citing_authors(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_citing_authors(info, mode="basic", embed_url=EMBED_URL):
     query_6 = (
         """
   SELECT
@@ -411,11 +904,12 @@ def get_query_url_for_citing_authors(info, mode="basic"):
 
     # Either show the ORCID iD or construct part of a URL to search on the ORCID homepage
     (COALESCE(?orcid_, CONCAT("orcid-search/quick-search/?searchQuery=", ENCODE_FOR_URI(?citing_authorLabel))) AS ?orcid)
+"""
+        + get_selection_subquery(info, mode)
+        + """
   WITH {
     SELECT (COUNT(?citing_work) AS ?count) ?citing_author WHERE {
-    """
-        + get_selector(info, mode)
-        + """
+      INCLUDE %selection
       ?citing_work wdt:P2860 ?work . 
       ?citing_work wdt:P50 ?citing_author .
     }
@@ -445,16 +939,19 @@ def get_query_url_for_citing_authors(info, mode="basic"):
 
   """
     )
-    return render_url(query_6)
+    return render_url(query_6, embed_url)
 
 
-def get_query_url_for_authors(info, mode="basic"):
+@cached_query_url
+def get_query_url_for_authors(info, mode="basic", embed_url=EMBED_URL):
     query_7 = (
         """
-  SELECT (COUNT(?work) AS ?count) ?author ?authorLabel ?orcids  WHERE {
-  """
-        + get_selector(info, mode)
+  SELECT (COUNT(?work) AS ?count) ?author ?authorLabel ?orcids
+"""
+        + get_selection_subquery(info, mode)
         + """
+  WHERE {
+    INCLUDE %selection
     ?work wdt:P50 ?author .
       OPTIONAL { ?author wdt:P496 ?orcids }
     SERVICE wikibase:label { bd:serviceParam wikibase:language "en,da,de,es,fr,jp,nl,no,ru,sv,zh". }
@@ -465,4 +962,4 @@ def get_query_url_for_authors(info, mode="basic"):
 
   """
     )
-    return render_url(query_7)
+    return render_url(query_7, embed_url)
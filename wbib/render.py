@@ -1,4 +1,12 @@
-from wbib import wbib
+import math
+from concurrent.futures import ThreadPoolExecutor
+from wbib import instrumentation, queries
+from wbib.qids import QIDSet
+
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+
+# Number of section queries run at the same time when materializing a dashboard.
+MATERIALIZE_MAX_WORKERS = 4
 
 # Example of query_options dictionary:
 # import queries
@@ -26,20 +34,204 @@ from wbib import wbib
 # }
 
 
-def render_section(query_name, query_options, info, mode):
+def _build_url(query_url, info, mode, embed_url):
+    if embed_url is None:
+        return query_url(info, mode)
+    return query_url(info, mode, embed_url=embed_url)
+
+
+def shard_query_urls(query_url, info, mode, max_url_bytes, embed_url=None):
+    """
+    Builds the URLs for a query, splitting the QIDs into shards until each URL
+    fits in the byte budget.
+
+    Only "basic" mode selectors can be split. Aggregates (counts, rankings) are
+    computed per shard, not across the whole set.
+
+    Args:
+        query_url (function): A query builder such as `wbib.queries.get_query_url_for_authors`.
+        info: Either a dict containing complex information for the selector or a list of QIDs.
+        mode (str): Either "basic" or "advanced".
+        max_url_bytes (int): The maximum length of a URL. None means no limit.
+        embed_url (str): The prefix of the URLs, passed on to the query builder.
+            None means the builder default.
+
+    Returns:
+        list: The URLs, one per shard.
+    """
+    url = _build_url(query_url, info, mode, embed_url)
+    if max_url_bytes is None or len(url) <= max_url_bytes or mode != "basic":
+        return [url]
+
+    qids = QIDSet(info)
+    if len(qids) <= 1:
+        # A single QID cannot be split further, however long its URL.
+        return [url]
+    number_of_shards = min(len(qids), math.ceil(len(url) / max_url_bytes))
+    while True:
+        urls = [
+            _build_url(query_url, shard, mode, embed_url)
+            for shard in qids.split(number_of_shards)
+        ]
+        if number_of_shards == len(qids) or all(
+            len(shard_url) <= max_url_bytes for shard_url in urls
+        ):
+            return urls
+        number_of_shards = min(len(qids), number_of_shards * 2)
+
+
+def render_section(
+    query_name, query_options, info, mode, max_url_bytes=None, embed_url=None
+):
 
     legend = query_options[query_name]["label"]
     query_url = query_options[query_name]["query"]
+    with instrumentation.span("render_section", section=query_name) as attributes:
+        shards = shard_query_urls(query_url, info, mode, max_url_bytes, embed_url)
+        if attributes is not None:
+            attributes["shards"] = len(shards)
+            attributes["url_bytes"] = sum(len(shard) for shard in shards)
+
+    return {"legend": legend, "query": shards[0], "shards": shards}
+
+
+def results_to_table(result):
+    """
+    Converts SPARQL JSON results into a table that the template can render.
 
-    return {"legend": legend, "query": query_url(info, mode)}
+    Args:
+        result (dict): The SPARQL JSON results.
 
+    Returns:
+        dict: The "columns" (variable names) and "rows", where each cell is a dict with
+            the "text" to show and an "href" for entities (None otherwise).
+    """
+    columns = result["head"]["vars"]
+    rows = []
+    for binding in result["results"]["bindings"]:
+        row = []
+        for column in columns:
+            cell = binding.get(column)
+            if cell is None:
+                row.append({"text": "", "href": None})
+            elif cell["type"] == "uri":
+                row.append(
+                    {
+                        "text": cell["value"].replace(ENTITY_PREFIX, ""),
+                        "href": cell["value"],
+                    }
+                )
+            else:
+                row.append({"text": cell["value"], "href": None})
+        rows.append(row)
+    return {"columns": columns, "rows": rows}
 
-def render_sections(query_name_list, query_options, info, mode):
+
+def materialize_sections(
+    sections,
+    executor,
+    max_workers=MATERIALIZE_MAX_WORKERS,
+    embed_url=None,
+    combine=False,
+):
+    """
+    Runs the queries of rendered sections and stores their results in the sections,
+    so that the dashboard shows static tables instead of live iframes.
+
+    Args:
+        sections (list): Sections from `render_sections`. Each one gets a "results" key
+            with one table (see `results_to_table`) per shard, and a "data" key with the
+            SPARQL JSON results they were built from.
+        executor (function): Takes a SPARQL query and returns the SPARQL JSON results,
+            such as `wbib.sparql.perform_query`.
+        max_workers (int): The maximum number of queries run at the same time.
+        embed_url (str): The prefix the section URLs were built with, if not the default.
+        combine (bool): If True, and no section was split into shards, all the sections
+            are fetched with a single query built by `wbib.queries.combine_queries`,
+            which evaluates the selector once. Defaults to False.
+
+    Returns:
+        list: The same sections.
+    """
+    if combine and all(len(section["shards"]) == 1 for section in sections):
+        named_queries = [
+            (str(index), queries.query_from_url(section["query"], embed_url))
+            for index, section in enumerate(sections)
+        ]
+        split_results = queries.split_combined_results(
+            executor(queries.combine_queries(named_queries)), named_queries
+        )
+        for index, section in enumerate(sections):
+            section["data"] = [split_results[str(index)]]
+            section["results"] = [results_to_table(split_results[str(index)])]
+        return sections
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            [
+                pool.submit(executor, queries.query_from_url(url, embed_url))
+                for url in section["shards"]
+            ]
+            for section in sections
+        ]
+        for section, section_futures in zip(sections, futures):
+            section["data"] = [future.result() for future in section_futures]
+            section["results"] = [results_to_table(data) for data in section["data"]]
+    return sections
+
+
+def render_sections(
+    query_name_list,
+    query_options,
+    info,
+    mode,
+    max_url_bytes=None,
+    executor=None,
+    embed_url=None,
+    combine_sections=False,
+):
+    """
+    Renders the sections of a dashboard.
+
+    Args:
+        query_name_list (list): Names of the queries to be included in the dashboard.
+        query_options (dict): A set of queries that might be used by the dashboard.
+        info: Either a dict containing complex information for the selector or a list of QIDs.
+        mode (str): Either "basic" or "advanced".
+        max_url_bytes (int): The maximum length of an embed URL. Sections whose URL is
+            longer are split into several shards, each embedded on its own. Defaults to
+            None (no limit).
+        executor (function): If given, the queries are run at build time through this
+            function (see `materialize_sections`) and their results are embedded in the
+            sections. Defaults to None (live iframes).
+        embed_url (str): The prefix of the embed URLs, for example to point the iframes
+            at a mirror of WDQS. Custom query builders need to accept it as a keyword
+            argument. Defaults to None (the builder default).
+        combine_sections (bool): When materializing, fetch all sections with a single
+            combined query. See `materialize_sections`. Defaults to False.
+
+    Returns:
+        list: One dict per section, with the "legend", the "query" URL and the URLs of all
+            the "shards" (a single one when the section was not split). Materialized sections
+            also hold the query "results" and the raw "data".
+    """
 
     sections = []
     for name in query_name_list:
         sections.append(
-            render_section(name, query_options=query_options, info=info, mode=mode)
+            render_section(
+                name,
+                query_options=query_options,
+                info=info,
+                mode=mode,
+                max_url_bytes=max_url_bytes,
+                embed_url=embed_url,
+            )
+        )
+
+    if executor is not None:
+        materialize_sections(
+            sections, executor, embed_url=embed_url, combine=combine_sections
         )
 
     return sections
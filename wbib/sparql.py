@@ -0,0 +1,476 @@
+"""Helpers for sending SPARQL queries to a Wikidata Query Service endpoint.
+"""
+
+import email.utils
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wbib import instrumentation
+
+# requests and asyncio are imported where they are used, to keep `import wbib` fast.
+
+WDQS_ENDPOINT = "https://query.wikidata.org/sparql"
+
+USER_AGENT = "wbib (https://github.com/lubianat/wbib)"
+
+# Status codes after which a request is retried.
+RETRY_STATUS_CODES = (429, 503)
+
+JSON_MEDIA_TYPE = "application/sparql-results+json"
+TSV_MEDIA_TYPE = "text/tab-separated-values"
+
+_TSV_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", '"': '"', "'": "'", "\\": "\\"}
+_STREAM_CHUNK_SIZE = 65536
+
+
+def perform_query(query, endpoint=WDQS_ENDPOINT, session=None, cache=None):
+    """
+    Sends a SPARQL query to an endpoint and returns the parsed JSON response.
+
+    The query is sent in the body of a POST request, so that queries with large
+    VALUES blocks do not run into URL length limits.
+
+    Args:
+        query (str): A valid SPARQL query.
+        endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+        session (requests.Session): An optional session to reuse connections across calls.
+        cache (wbib.cache.SPARQLCache): An optional result cache. Any object with
+            `get(query, endpoint)` and `set(query, endpoint, result)` methods works.
+
+    Returns:
+        dict: The SPARQL JSON results.
+
+    Raises:
+        requests.exceptions.HTTPError: If the endpoint answers with an error status.
+    """
+
+    if cache is not None:
+        result = cache.get(query, endpoint)
+        if result is not None:
+            return result
+
+    import requests
+
+    http = session if session is not None else requests
+    with instrumentation.span("sparql_request", endpoint=endpoint) as attributes:
+        response = http.post(
+            endpoint,
+            data={"query": query},
+            headers={
+                "Accept": JSON_MEDIA_TYPE,
+                "User-Agent": USER_AGENT,
+            },
+        )
+        if attributes is not None:
+            attributes["query_bytes"] = len(query.encode("utf-8"))
+            attributes["status"] = response.status_code
+    response.raise_for_status()
+    result = response.json()
+
+    if cache is not None:
+        cache.set(query, endpoint, result)
+    return result
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, refilled at `rate` tokens per second up to `capacity`.
+
+    Args:
+        rate (float): The number of tokens added per second.
+        capacity (float): The maximum number of tokens. Defaults to `rate`, that is,
+            bursts of at most one second worth of requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, blocking until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _unescape_tsv(text):
+    if "\\" not in text:
+        return text
+    characters = []
+    position = 0
+    while position < len(text):
+        character = text[position]
+        if character == "\\" and position + 1 < len(text):
+            position += 1
+            character = _TSV_ESCAPES.get(text[position], "\\" + text[position])
+        characters.append(character)
+        position += 1
+    return "".join(characters)
+
+
+def parse_tsv_term(term):
+    """
+    Reads the value of an RDF term as written in SPARQL TSV results.
+
+    IRIs lose their angle brackets, literals lose their quotes, language tag
+    and datatype, and unbound values become None.
+
+    Args:
+        term (str): A single field of a TSV result row.
+
+    Returns:
+        str: The value of the term, or None if the field is empty.
+    """
+    if not term:
+        return None
+    if term[0] == "<" and term[-1] == ">":
+        return term[1:-1]
+    if term[0] == '"':
+        return _unescape_tsv(term[1 : term.rindex('"')])
+    return term
+
+
+def _iter_lines(chunks):
+    """Splits a stream of byte chunks into decoded lines, keeping memory bounded."""
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8")
+    if pending:
+        yield pending.rstrip(b"\r").decode("utf-8")
+
+
+def iter_tsv_rows(lines):
+    """
+    Parses SPARQL TSV results one line at a time.
+
+    Args:
+        lines (iterable): The lines of the response, header first.
+
+    Yields:
+        dict: One dict per result row, mapping variable names (without "?")
+            to values, as returned by `parse_tsv_term`.
+    """
+    lines = iter(lines)
+    header = next(lines, None)
+    if header is None:
+        return
+    variables = [name.lstrip("?$") for name in header.split("\t")]
+    for line in lines:
+        if not line:
+            continue
+        yield dict(zip(variables, map(parse_tsv_term, line.split("\t"))))
+
+
+def iter_json_rows(result):
+    """
+    Reads the rows of SPARQL JSON results with the same shape as `iter_tsv_rows`.
+
+    Args:
+        result (dict): The SPARQL JSON results.
+
+    Yields:
+        dict: One dict per result row, mapping variable names to values.
+            Unbound variables map to None.
+    """
+    variables = result["head"]["vars"]
+    for binding in result["results"]["bindings"]:
+        yield {
+            name: binding[name]["value"] if name in binding else None
+            for name in variables
+        }
+
+
+def _parse_retry_after(value):
+    """Returns the number of seconds to wait from a Retry-After header, or None."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class AsyncSPARQLClient:
+    """
+    A SPARQL client for running many queries concurrently against one endpoint.
+
+    Requests share a pooled HTTP session and run on a bounded pool of workers, so
+    at most `max_concurrency` queries are in flight at any time. An optional token
+    bucket limits the request rate, and requests answered with 429 or 503 are retried
+    with exponential backoff, waiting at least as long as the Retry-After header asks.
+
+    Queries can be awaited with `query` and `query_many`, or run from synchronous code
+    with `run`. The client is also callable with a single query, so it can be used as
+    the `executor` of `wbib.wbib.render_dashboard`.
+
+    Every request attempt is recorded in `timings`, as a dict with the "seconds" it took,
+    the HTTP "status" (None on connection errors) and the "attempt" number.
+
+    Args:
+        endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+        max_concurrency (int): The maximum number of requests in flight.
+        rate (float): The maximum number of requests started per second.
+            Defaults to None (no rate limit).
+        max_retries (int): The maximum number of retries of a single query.
+        backoff (float): The wait in seconds before the first retry, doubled on each retry.
+        max_backoff (float): The longest wait between two retries, in seconds.
+        timeout (float): The timeout of each request, in seconds.
+        cache (wbib.cache.SPARQLCache): An optional result cache.
+    """
+
+    def __init__(
+        self,
+        endpoint=WDQS_ENDPOINT,
+        max_concurrency=4,
+        rate=None,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=60.0,
+        timeout=60.0,
+        cache=None,
+    ):
+        self.endpoint = endpoint
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.timings = []
+        import requests
+
+        self._bucket = TokenBucket(rate) if rate is not None else None
+        self._timings_lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_concurrency
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update(
+            {"Accept": JSON_MEDIA_TYPE, "User-Agent": USER_AGENT}
+        )
+        self._workers = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def _record(self, started_at, status, attempt):
+        with self._timings_lock:
+            self.timings.append(
+                {
+                    "seconds": time.perf_counter() - started_at,
+                    "status": status,
+                    "attempt": attempt,
+                }
+            )
+
+    def _wait_before_retry(self, attempt, retry_after=None):
+        wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+        wait = wait * (0.5 + random.random() / 2)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        time.sleep(wait)
+
+    def _post(self, query, accept=JSON_MEDIA_TYPE, stream=False):
+        """Sends a query, retrying on 429/503, and returns the successful response."""
+        import requests
+
+        attempt = 0
+        while True:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            started_at = time.perf_counter()
+            with instrumentation.span(
+                "sparql_request", endpoint=self.endpoint, attempt=attempt
+            ) as attributes:
+                try:
+                    response = self._session.post(
+                        self.endpoint,
+                        data={"query": query},
+                        headers={"Accept": accept},
+                        timeout=self.timeout,
+                        stream=stream,
+                    )
+                except requests.exceptions.RequestException:
+                    self._record(started_at, None, attempt)
+                    raise
+                if attributes is not None:
+                    attributes["query_bytes"] = len(query.encode("utf-8"))
+                    attributes["status"] = response.status_code
+
+            self._record(started_at, response.status_code, attempt)
+            if (
+                response.status_code in RETRY_STATUS_CODES
+                and attempt < self.max_retries
+            ):
+                response.close()
+                instrumentation.count(
+                    "sparql_retries",
+                    status=response.status_code,
+                    endpoint=self.endpoint,
+                )
+                self._wait_before_retry(
+                    attempt, _parse_retry_after(response.headers.get("Retry-After"))
+                )
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def execute(self, query):
+        """
+        Runs a query, blocking until its results arrive. Retries are handled here.
+
+        Args:
+            query (str): A valid SPARQL query.
+
+        Returns:
+            dict: The SPARQL JSON results.
+
+        Raises:
+            requests.exceptions.HTTPError: If the endpoint answers with an error status,
+                or still answers 429/503 after `max_retries` retries.
+            requests.exceptions.ConnectionError: If the endpoint is unreachable.
+        """
+        if self.cache is not None:
+            result = self.cache.get(query, self.endpoint)
+            if result is not None:
+                return result
+
+        result = self._post(query).json()
+        if self.cache is not None:
+            self.cache.set(query, self.endpoint, result)
+        return result
+
+    def iter_rows(self, query):
+        """
+        Runs a query and parses its results as they arrive, without building the
+        whole response in memory.
+
+        The results are requested as TSV and read line by line. Endpoints that
+        answer with JSON anyway are also understood. When the client has a cache,
+        the results go through `execute` instead, so that they can be stored.
+
+        Args:
+            query (str): A valid SPARQL query.
+
+        Yields:
+            dict: One dict per result row, mapping variable names to values.
+
+        Raises:
+            requests.exceptions.HTTPError: See `execute`.
+            requests.exceptions.ConnectionError: See `execute`.
+        """
+        if self.cache is not None:
+            yield from iter_json_rows(self.execute(query))
+            return
+
+        accept = "{}, {};q=0.5".format(TSV_MEDIA_TYPE, JSON_MEDIA_TYPE)
+        with self._post(query, accept=accept, stream=True) as response:
+            content_type = response.headers.get("Content-Type", "")
+            if "json" in content_type:
+                yield from iter_json_rows(response.json())
+            else:
+                chunks = response.iter_content(chunk_size=_STREAM_CHUNK_SIZE)
+                yield from iter_tsv_rows(_iter_lines(chunks))
+
+    def run_rows(self, queries):
+        """
+        Runs many queries concurrently, parsing each response with `iter_rows`.
+
+        Args:
+            queries (iterable): Valid SPARQL queries.
+
+        Returns:
+            iterator: The rows of each query as a list, in the same order as `queries`.
+        """
+        return self._workers.map(lambda query: list(self.iter_rows(query)), queries)
+
+    def run_raw(self, queries, accept):
+        """
+        Runs many queries concurrently, returning the responses as they were sent.
+        Meant for CONSTRUCT queries, whose results are not SPARQL JSON. The cache is
+        not used.
+
+        Args:
+            queries (iterable): Valid SPARQL queries.
+            accept (str): The media type to ask for, such as "text/turtle".
+
+        Returns:
+            iterator: The body of each response as bytes, in the same order as `queries`.
+        """
+        return self._workers.map(
+            lambda query: self._post(query, accept=accept).content, queries
+        )
+
+    async def query(self, query):
+        """
+        Runs a query without blocking the event loop.
+
+        Args:
+            query (str): A valid SPARQL query.
+
+        Returns:
+            dict: The SPARQL JSON results.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._workers, self.execute, query)
+
+    async def query_many(self, queries):
+        """
+        Runs many queries concurrently.
+
+        Args:
+            queries (list): Valid SPARQL queries.
+
+        Returns:
+            list: The SPARQL JSON results, in the same order as `queries`.
+        """
+        import asyncio
+
+        return await asyncio.gather(*(self.query(query) for query in queries))
+
+    def run(self, queries):
+        """
+        Runs many queries concurrently from synchronous code.
+
+        Args:
+            queries (list): Valid SPARQL queries.
+
+        Returns:
+            list: The SPARQL JSON results, in the same order as `queries`.
+        """
+        return list(self._workers.map(self.execute, queries))
+
+    def __call__(self, query):
+        return self.execute(query)
+
+    def close(self):
+        self._workers.shutdown()
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
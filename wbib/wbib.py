@@ -1,15 +1,24 @@
 """Main functions for the use by end users.
 """
 
-import pandas as pd
+import functools
+import hashlib
+import json
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from wbib import queries, render
-from wikidata2df import wikidata2df
-from jinja2 import Environment, PackageLoader
+from wbib import dois, export, identifiers, instrumentation, queries, render, sparql
+from wbib.qids import QIDSet
 
-env = Environment(
-    loader=PackageLoader("wbib", "templates"),
-)
+# jinja2 and yaml are imported where they are used,
+# so that `import wbib` stays fast for short-lived processes.
+_env = None
+_template = None
+_template_source = None
+
+# Number of template chunks written at once when streaming a dashboard to disk.
+STREAM_BUFFER_SIZE = 64
 
 DEFAULT_QUERY_OPTIONS = {
     "map of institutions": {
@@ -54,6 +63,11 @@ DEFAULT_SESSIONS = [
 
 EXAMPLE_PAGES = {"home": {"href": "/", "name": "Home"}}
 
+# Number of DOIs sent in a single query, and number of queries run at the same time.
+# WDQS allows up to 5 concurrent queries per client.
+DOI_CHUNK_SIZE = 1000
+DOI_MAX_WORKERS = 4
+
 
 def render_dashboard(
     info,
@@ -64,6 +78,19 @@ def render_dashboard(
     site_subtitle="A dashboard for Wikidata-based bibliometrics for a given set of articles.",
     filepath=".",
     pages={},
+    incremental=False,
+    max_url_bytes=None,
+    materialize=False,
+    executor=None,
+    endpoint=None,
+    embed_url=None,
+    optimize=False,
+    combine_sections=False,
+    return_html=True,
+    export_directory=None,
+    export_format="arrow",
+    lazy_load=False,
+    split_pages=False,
 ):
     """
     Renders a plain html string coding for a dashboard with embedded Wikidata SPARQL queries.
@@ -119,6 +146,7 @@ def render_dashboard(
     ```
     Args:
         info (dict): Either a dict containing complex information for the selector or a list of QIDs.
+            Large lists of QIDs can be passed as a `wbib.qids.QIDSet` to save memory.
         mode (str): A string representing the mode. If "advanced", then a config is expected for the
             info parameters. If "basic", a list of QIDs is expected. Defaults to "advanced".
         query_options (dict): A set of queries that might be used by the dashboard.
@@ -129,12 +157,188 @@ def render_dashboard(
         site_subtitle (str): A subtitle for the dashboard (if in "basic" mode)
         filepath (str): The filepath to write the dashboard to.
         pages (dict): The pages that will be part of the final dashboard, as to make a simple navbar.
+        incremental (bool): If True, the inputs of the dashboard are fingerprinted and stored
+            in a manifest next to the html file. When the fingerprint matches the one from the
+            previous build, the file is left untouched. Defaults to False.
+        max_url_bytes (int): The maximum length of an embedded query URL. In "basic" mode,
+            sections with longer URLs are split into shards over the QIDs, each in its own
+            iframe. Defaults to None (no limit).
+        materialize (bool): If True, the section queries are run once at build time and
+            their results are embedded as static tables, instead of iframes that query
+            WDQS on every page view. Defaults to False.
+        executor (function): The function used to run queries at build time, when
+            materializing or optimizing. It takes a SPARQL query and returns the SPARQL
+            JSON results.
+            Defaults to `wbib.sparql.perform_query` on `endpoint`.
+        endpoint (str): The SPARQL endpoint queried at build time when materializing.
+            In "advanced" mode, it can also be set with an "endpoint" key in the yaml file.
+            Defaults to the public WDQS.
+        embed_url (str): The prefix of the embedded query URLs, for example the embed page
+            of a mirror of WDQS. In "advanced" mode, it can also be set with an "embed_url"
+            key in the yaml file. Defaults to the embed page of the public WDQS.
+        optimize (bool): In "advanced" mode, builds faster selectors: subclass and part-of
+            closures of the restrictions are queried once at build time (through `executor`)
+            and the most selective restriction is evaluated first.
+            See `wbib.queries.optimize_restrictions`. Defaults to False.
+        combine_sections (bool): When materializing, fetches all the sections with a single
+            query that evaluates the selector once, and splits its results per section.
+            Defaults to False.
+        return_html (bool): If False, the template is streamed straight to the file and
+            the html is never held in memory as a single string. Defaults to True.
+        export_directory (str): If given, the results of every section are also written
+            to this directory as typed columnar files, with a manifest (see
+            `wbib.export.export_sections`). The queries run through `executor`, or are
+            taken from the materialized sections. Needs pyarrow. Defaults to None.
+        export_format (str): Either "arrow" (memory-mappable Arrow IPC files) or
+            "parquet". Defaults to "arrow".
+        lazy_load (bool): If True, the embedded queries only run once their section is
+            scrolled into view or its "Run query" button is clicked, instead of all at
+            once when the page opens. Opening the page runs at most one query: that of
+            the first section in view. Defaults to False.
+        split_pages (bool): If True, each section is written to its own page, linked
+            from the navbar after `pages`. The first section goes to the dashboard file
+            and the others next to it, as "<name>_<section>.html". Defaults to False.
 
     Returns:
-        str: The html content for a static Wikidata-based dashboard.
+        str: The html content for a static Wikidata-based dashboard, or None if
+            `return_html` is False. With `split_pages`, the html of its first page.
             Note: also saves the file to the file system.
     """
 
+    result = _build_dashboard(
+        info,
+        mode=mode,
+        query_options=query_options,
+        sections_to_add=sections_to_add,
+        site_title=site_title,
+        site_subtitle=site_subtitle,
+        filepath=filepath,
+        pages=pages,
+        incremental=incremental,
+        max_url_bytes=max_url_bytes,
+        materialize=materialize,
+        executor=executor,
+        endpoint=endpoint,
+        embed_url=embed_url,
+        optimize=optimize,
+        combine_sections=combine_sections,
+        return_html=return_html,
+        export_directory=export_directory,
+        export_format=export_format,
+        lazy_load=lazy_load,
+        split_pages=split_pages,
+    )
+    if return_html and result["html"] is None:
+        return result["path"].read_text(encoding="utf-8")
+    return result["html"]
+
+
+def _get_environment():
+    global _env
+    if _env is None:
+        from jinja2 import Environment, PackageLoader
+
+        _env = Environment(
+            loader=PackageLoader("wbib", "templates"),
+        )
+    return _env
+
+
+def __getattr__(name):
+    # The jinja2 Environment is still reachable as `wbib.wbib.env`, but only
+    # created on first use.
+    if name == "env":
+        return _get_environment()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def enable_bytecode_cache(directory=None):
+    """
+    Caches the compiled template on disk, so that short-lived processes skip
+    compiling it.
+
+    Args:
+        directory (str): The directory for the cache. Defaults to a directory in the
+            system temporary folder, as chosen by `jinja2.FileSystemBytecodeCache`.
+    """
+    from jinja2 import FileSystemBytecodeCache
+
+    global _template
+    env = _get_environment()
+    env.bytecode_cache = FileSystemBytecodeCache(directory)
+    if env.cache is not None:
+        env.cache.clear()
+    _template = None
+
+
+def _load_template():
+    global _template
+    if _template is None:
+        _template = _get_environment().get_template("template.html.jinja")
+    return _template
+
+
+def _load_template_source():
+    global _template_source
+    if _template_source is None:
+        env = _get_environment()
+        _template_source = env.loader.get_source(env, "template.html.jinja")[0]
+    return _template_source
+
+
+def _serialize_for_fingerprint(value):
+    if isinstance(value, QIDSet):
+        return list(value)
+    if hasattr(value, "__qualname__"):
+        # Query builders are named, as their repr holds an address that changes per run.
+        return value.__module__ + "." + value.__qualname__
+    return str(value)
+
+
+def _fingerprint_dashboard(info, mode, sections, template_context):
+    """Hashes every input that affects the rendered html of a dashboard."""
+    inputs = {
+        "info": info,
+        "mode": mode,
+        "sections": sections,
+        "context": template_context,
+        "template": _load_template_source(),
+    }
+    serialized = json.dumps(
+        inputs, sort_keys=True, default=_serialize_for_fingerprint
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def _manifest_path(path_to_write):
+    return path_to_write.with_name(path_to_write.name + ".manifest.json")
+
+
+@instrumentation.traced("render_dashboard")
+def _build_dashboard(
+    info,
+    mode="basic",
+    query_options=DEFAULT_QUERY_OPTIONS,
+    sections_to_add=DEFAULT_SESSIONS,
+    site_title="Wikidata Bib Dashboard",
+    site_subtitle="A dashboard for Wikidata-based bibliometrics for a given set of articles.",
+    filepath=".",
+    pages={},
+    incremental=False,
+    max_url_bytes=None,
+    materialize=False,
+    executor=None,
+    endpoint=None,
+    embed_url=None,
+    optimize=False,
+    combine_sections=False,
+    return_html=True,
+    export_directory=None,
+    export_format="arrow",
+    lazy_load=False,
+    split_pages=False,
+):
+
     if mode == "advanced":
         if not isinstance(info, dict):
             raise TypeError(
@@ -147,6 +351,10 @@ def render_dashboard(
             site_title = info["title"]
             site_subtitle = info["subtitle"]
             sections_to_add = info["sections"]
+            if endpoint is None:
+                endpoint = info.get("endpoint")
+            if embed_url is None:
+                embed_url = info.get("embed_url")
 
     if mode == "basic":
 
@@ -163,37 +371,446 @@ def render_dashboard(
         Dashboard  generated via <a target="_blank" href="https://pypi.org/project/wbib/">Wikidata Bib</a>
         """
 
-    sections = render.render_sections(sections_to_add, query_options, info, mode)
+    if executor is None:
+        executor = functools.partial(
+            sparql.perform_query, endpoint=endpoint or sparql.WDQS_ENDPOINT
+        )
+
+    if optimize and mode == "advanced":
+        info = queries.optimize_restrictions(info, executor=executor)
+
+    try:
+        sections = render.render_sections(
+            sections_to_add,
+            query_options,
+            info,
+            mode,
+            max_url_bytes=max_url_bytes,
+            executor=executor if materialize else None,
+            embed_url=embed_url,
+            combine_sections=combine_sections,
+        )
+    finally:
+        # Selectors and URLs are only reused within a dashboard; the sections now
+        # hold the URLs they need.
+        queries.clear_query_cache(closures=False)
+    shards = {section["legend"]: len(section["shards"]) for section in sections}
+
+    if export_directory is not None:
+        export.export_sections(
+            sections, export_directory, executor, export_format, embed_url=embed_url
+        )
 
-    template = env.get_template("template.html.jinja")
-    rendered_template = template.render(
+    template_context = dict(
         site_title=site_title,
         site_subtitle=site_subtitle,
-        sections=sections,
         license_statement=license_statement,
         scholia_credit=scholia_credit_statement,
         creator_statement=creator_statement,
         pages=pages,
+        lazy_load=lazy_load,
     )
 
     filename = "{}.html".format(site_title.lower().strip().replace(" ", "_"))
     path_to_write = (
-        Path(filepath).joinpath(filename) if filepath is "." else Path(filepath)
+        Path(filepath).joinpath(filename) if filepath == "." else Path(filepath)
     )
 
-    with open(path_to_write, "w") as html:
-        html.write(rendered_template)
+    if split_pages:
+        site_pages = _split_pages(sections, path_to_write, template_context)
+    else:
+        site_pages = [(path_to_write, sections, template_context)]
+
+    if incremental:
+        fingerprint = _fingerprint_dashboard(
+            info, mode, sections, dict(template_context, split_pages=split_pages)
+        )
+        manifest_path = _manifest_path(path_to_write)
+        written = all(page_path.exists() for page_path, _, _ in site_pages)
+        if written and manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text())
+            if manifest.get("fingerprint") == fingerprint:
+                return {
+                    "html": None,
+                    "path": path_to_write,
+                    "pages": [page_path for page_path, _, _ in site_pages],
+                    "written": False,
+                    "shards": shards,
+                }
+
+    template = _load_template()
+    rendered_pages = [
+        _write_page(template, page_path, page_sections, context, return_html)
+        for page_path, page_sections, context in site_pages
+    ]
+
+    if incremental:
+        manifest_path.write_text(json.dumps({"fingerprint": fingerprint}))
+
+    return {
+        "html": rendered_pages[0],
+        "path": path_to_write,
+        "pages": [page_path for page_path, _, _ in site_pages],
+        "written": True,
+        "shards": shards,
+    }
+
+
+def _split_pages(sections, path_to_write, template_context):
+    """
+    Lays out one page per section, each with a navbar linking to all of them.
+
+    Returns:
+        list: A (path, sections, template context) tuple per page.
+    """
+    paths = [path_to_write]
+    for section in sections[1:]:
+        slug = re.sub(r"[^a-z0-9]+", "_", section["legend"].lower()).strip("_")
+        paths.append(
+            path_to_write.with_name("{}_{}.html".format(path_to_write.stem, slug))
+        )
+
+    navbar = dict(template_context["pages"])
+    for section, path in zip(sections, paths):
+        navbar[path.name] = {"href": path.name, "name": section["legend"]}
+
+    site_pages = []
+    for section, path in zip(sections, paths):
+        pages = {
+            key: dict(value, active=key == path.name) for key, value in navbar.items()
+        }
+        site_pages.append((path, [section], dict(template_context, pages=pages)))
+    return site_pages
+
+
+def _write_page(template, path_to_write, sections, template_context, return_html):
+    """Renders a page to its file, returning its html, or None when streamed."""
+    if return_html:
+        with instrumentation.span("render_template", streamed=False):
+            rendered_template = template.render(sections=sections, **template_context)
+        with instrumentation.span("write_file", path=str(path_to_write)) as attributes:
+            with open(path_to_write, "w", encoding="utf-8") as html:
+                html.write(rendered_template)
+            if attributes is not None:
+                attributes["bytes"] = path_to_write.stat().st_size
+        return rendered_template
+
+    # Rendering and writing are interleaved when streaming, so one span covers both.
+    with instrumentation.span("write_file", path=str(path_to_write)) as attributes:
+        stream = template.stream(sections=sections, **template_context)
+        stream.enable_buffering(STREAM_BUFFER_SIZE)
+        stream.dump(str(path_to_write), encoding="utf-8")
+        if attributes is not None:
+            attributes["streamed"] = True
+            attributes["bytes"] = path_to_write.stat().st_size
+    return None
+
+
+def _render_dashboard_config(config, incremental=False):
+    import yaml
+
+    start = time.perf_counter()
+    result = {
+        "config": config,
+        "path": None,
+        "written": False,
+        "shards": None,
+        "seconds": None,
+        "error": None,
+    }
+    try:
+        if isinstance(config, dict):
+            kwargs = dict(config)
+        else:
+            with open(config) as config_file:
+                kwargs = {
+                    "info": yaml.load(config_file, Loader=yaml.FullLoader),
+                    "mode": "advanced",
+                }
+        kwargs.setdefault("incremental", incremental)
+        kwargs.setdefault("return_html", False)
+        build = _build_dashboard(**kwargs)
+        result["path"] = build["path"]
+        result["written"] = build["written"]
+        result["shards"] = build["shards"]
+    except Exception as error:
+        result["error"] = error
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def render_dashboards(configs, workers=None, use_processes=False, incremental=False):
+    """
+    Renders many dashboards at once in a pool of threads or processes.
+
+    The template is loaded once and shared by every dashboard rendered in the
+    same process, and each dashboard is streamed to its file. A dashboard that
+    fails to render does not stop the others: its error is reported in its
+    result instead.
+
+    Args:
+        configs (list): The dashboards to render. Each one is either the path to a
+            yaml config file, rendered in "advanced" mode, or a dict with keyword
+            arguments for `render_dashboard`.
+        workers (int): The maximum number of dashboards rendered at the same time.
+            Defaults to the executor default.
+        use_processes (bool): If True, renders in a process pool instead of a thread pool,
+            so that the work is spread across all cores. Defaults to False.
+        incremental (bool): If True, dashboards whose inputs did not change since the
+            previous build are skipped. See `render_dashboard`. Defaults to False.
+
+    Returns:
+        list: One dict per config, in the same order as `configs`, with the keys
+            "config", "path" (the html file), "written" (False if the file was skipped
+            or failed), "shards" (the number of shards of each section), "seconds"
+            (the wall-clock time spent) and "error" (the exception raised, or None).
+    """
+
+    if use_processes:
+        executor_class = ProcessPoolExecutor
+    else:
+        _load_template()
+        executor_class = ThreadPoolExecutor
+
+    with executor_class(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                _render_dashboard_config, configs, [incremental] * len(configs)
+            )
+        )
+
+
+def _plan_lookups(identifiers_to_resolve, kind, chunk_size):
+    """
+    Groups identifiers by type and splits each group into chunks of normalized values.
+
+    Returns:
+        tuple: A list of (kind, identifiers_by_value) chunks, and the set of
+            identifiers whose type was not recognized.
+    """
+    if chunk_size < 1:
+        raise ValueError("'chunk_size' needs to be a positive integer")
+
+    groups = {}
+    unrecognized = set()
+    for identifier in identifiers_to_resolve:
+        if isinstance(identifier, tuple):
+            identifier_kind, identifier = identifier
+            value = identifiers.normalize_identifier(identifier, identifier_kind)
+        elif kind is not None:
+            identifier_kind = kind
+            value = identifiers.normalize_identifier(identifier, kind)
+        else:
+            identifier_kind, value = identifiers.detect_identifier(identifier)
+        if value is None:
+            unrecognized.add(identifier)
+            continue
+        group = groups.setdefault(identifier_kind, {})
+        originals = group.setdefault(value, [])
+        if identifier not in originals:
+            originals.append(identifier)
+
+    # Sorting keeps chunks stable across runs, so that cached chunks can be reused.
+    chunks = []
+    for identifier_kind in sorted(groups):
+        values = sorted(groups[identifier_kind])
+        for i in range(0, len(values), chunk_size):
+            chunks.append(
+                (
+                    identifier_kind,
+                    {
+                        value: groups[identifier_kind][value]
+                        for value in values[i : i + chunk_size]
+                    },
+                )
+            )
+    return chunks, unrecognized
+
+
+def _resolve_chunks(chunks, client, index=None):
+    """
+    Runs one lookup query per (kind, identifiers_by_value) chunk, yielding
+    (chunk, pairs) in order. Chunks of a type covered by `index` are looked up
+    in the index instead.
+    """
+    online = [chunk for chunk in chunks if index is None or chunk[0] not in index.kinds]
+    lookup_queries = [
+        identifiers.build_lookup_query(list(by_value), chunk_kind)
+        for chunk_kind, by_value in online
+    ]
+    results = client.run_rows(lookup_queries) if online else iter(())
+    for chunk in chunks:
+        chunk_kind, by_value = chunk
+        if index is not None and chunk_kind in index.kinds:
+            pairs = [
+                (identifier, qid)
+                for value, originals in by_value.items()
+                for qid in index.lookup(value, chunk_kind)
+                for identifier in originals
+            ]
+            yield chunk, pairs
+        else:
+            yield chunk, identifiers.match_rows(by_value, next(results))
+
+
+def _run_lookups(chunks, max_workers, endpoint, cache, client, index=None):
+    if client is None:
+        with sparql.AsyncSPARQLClient(
+            endpoint=endpoint, max_concurrency=max_workers, cache=cache
+        ) as own_client:
+            for chunk, pairs in _resolve_chunks(chunks, own_client, index):
+                yield from pairs
+    else:
+        for chunk, pairs in _resolve_chunks(chunks, client, index):
+            yield from pairs
+
+
+def iter_identifier_qids(
+    identifiers_to_resolve,
+    kind=None,
+    chunk_size=DOI_CHUNK_SIZE,
+    max_workers=DOI_MAX_WORKERS,
+    endpoint=sparql.WDQS_ENDPOINT,
+    cache=None,
+    client=None,
+    index=None,
+):
+    """
+    Resolves external identifiers to Wikidata QIDs, yielding each match as soon as
+    its chunk is parsed.
+
+    Identifiers are normalized and grouped by type (see `wbib.identifiers`), and each
+    type is looked up on its own property, `chunk_size` identifiers per query.
+    Identifiers without a match, or of an unrecognized type, are not yielded, and an
+    identifier linked to several items is yielded once per item.
+
+    Args:
+      identifiers_to_resolve (list): Identifiers such as DOIs, PubMed IDs, PMCIDs,
+        arXiv IDs or ORCIDs. Items can also be (kind, identifier) pairs, such as
+        ("pmcid", "3170271"), to skip type detection.
+      kind (str): The type of all the identifiers, one of the keys of
+        `wbib.identifiers.PROPERTIES`. Defaults to None (detected per identifier).
+      chunk_size (int): The maximum number of identifiers sent in a single query.
+      max_workers (int): The maximum number of queries running concurrently.
+      endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+      cache (wbib.cache.SPARQLCache): An optional cache for the query results.
+      client (wbib.sparql.AsyncSPARQLClient): An optional client to run the queries with.
+        When given, `max_workers`, `endpoint` and `cache` are taken from the client instead.
+      index (wbib.index.IdentifierIndex): An optional offline index. Identifiers of the
+        types it was built for are looked up in it instead of on the endpoint.
+
+    Yields:
+      tuple: (identifier, qid) pairs, with the identifier as given.
+    """
+    chunks, _ = _plan_lookups(identifiers_to_resolve, kind, chunk_size)
+    yield from _run_lookups(chunks, max_workers, endpoint, cache, client, index)
+
+
+def resolve_identifiers(
+    identifiers_to_resolve,
+    kind=None,
+    chunk_size=DOI_CHUNK_SIZE,
+    max_workers=DOI_MAX_WORKERS,
+    endpoint=sparql.WDQS_ENDPOINT,
+    cache=None,
+    client=None,
+    index=None,
+):
+    """
+    Resolves a mix of external identifiers to Wikidata QIDs.
+
+    Takes the same arguments as `iter_identifier_qids`. For example:
+
+        resolve_identifiers(["10.3897/RIO.2.E9342", "PMC3170271", "31361758"])
+
+    Returns:
+      dict: The "qids" key maps each identifier found, as given, to the set of its
+          QIDs. The "missing" key holds the set of valid identifiers not found on
+          Wikidata, and the "unrecognized" key the identifiers of unknown type.
+    """
+    chunks, unrecognized = _plan_lookups(identifiers_to_resolve, kind, chunk_size)
+    qids = {}
+    span = instrumentation.span("resolve_identifiers", chunk_size=chunk_size)
+    with span as attributes:
+        for identifier, qid in _run_lookups(
+            chunks, max_workers, endpoint, cache, client, index
+        ):
+            qids.setdefault(identifier, set()).add(qid)
+        if attributes is not None:
+            attributes["identifiers"] = sum(len(chunk[1]) for chunk in chunks)
+            attributes["qids"] = sum(len(found) for found in qids.values())
+
+    missing = set()
+    for chunk_kind, by_value in chunks:
+        for originals in by_value.values():
+            missing.update(
+                identifier for identifier in originals if identifier not in qids
+            )
+    return {"qids": qids, "missing": missing, "unrecognized": unrecognized}
+
 
-    return rendered_template
+def iter_doi_qids(
+    list_of_dois,
+    chunk_size=DOI_CHUNK_SIZE,
+    max_workers=DOI_MAX_WORKERS,
+    endpoint=sparql.WDQS_ENDPOINT,
+    cache=None,
+    client=None,
+    index=None,
+):
+    """
+    Resolves DOIs to Wikidata QIDs, yielding each match as soon as its chunk is parsed.
+
+    The results are parsed row by row from the response, so no table of results is
+    ever built. DOIs without a match on Wikidata are not yielded, and a DOI linked
+    to several items is yielded once per item. See `iter_identifier_qids` for the
+    arguments.
+
+    Yields:
+      tuple: (doi, qid) pairs, with the DOI as given in `list_of_dois`.
+    """
+    yield from iter_identifier_qids(
+        list_of_dois,
+        kind="doi",
+        chunk_size=chunk_size,
+        max_workers=max_workers,
+        endpoint=endpoint,
+        cache=cache,
+        client=client,
+        index=index,
+    )
 
 
-def convert_doi_to_qid(list_of_dois):
+def convert_doi_to_qid(
+    list_of_dois,
+    chunk_size=DOI_CHUNK_SIZE,
+    max_workers=DOI_MAX_WORKERS,
+    endpoint=sparql.WDQS_ENDPOINT,
+    cache=None,
+    client=None,
+    index=None,
+):
     """
     Converts a list of DOI ids to Wikidata QIDs.
 
+    The DOIs are split into chunks of at most `chunk_size` DOIs, and each chunk
+    is resolved in its own query, with at most `max_workers` queries running at
+    the same time.
+
     Args:
       list_of_dois (list): DOIs without prefix. For example:
         ["10.3897/RIO.2.E9342", "10.3389/fimmu.2019.02736"]
+      chunk_size (int): The maximum number of DOIs sent in a single query.
+      max_workers (int): The maximum number of queries running concurrently.
+      endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+      cache (wbib.cache.SPARQLCache): An optional cache for the query results.
+        Chunks resolved in an earlier run are then read from the cache. Defaults to None (no cache).
+      client (wbib.sparql.AsyncSPARQLClient): An optional client to run the queries with,
+        for example to share its rate limit with other calls. When given, `max_workers`,
+        `endpoint` and `cache` are taken from the client instead.
+      index (wbib.index.IdentifierIndex): An optional offline index built with DOIs
+        (see `wbib.index.build_index`). The DOIs are then looked up in the index, as
+        of the date of its dump, without querying the endpoint.
 
     Returns:
       dict: A dict with two key-value pairs. The "missing" key contains a set
@@ -201,31 +818,102 @@ def convert_doi_to_qid(list_of_dois):
           QIDs found on Wikidata.
     """
 
-    formatted_dois = '{ "' + '" "'.join(list_of_dois) + '"}'
-    query = f"""SELECT ?id ?item  ?itemLabel
-  WHERE {{
-      {{
-      SELECT ?item ?id WHERE {{
-          VALUES ?unformatted_id {formatted_dois}
-          BIND(UCASE(?unformatted_id) AS ?id)
-          ?item wdt:P356 ?id.
-      }}
-      }}
-      SERVICE wikibase:label 
-      {{ bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }}}}
-  """
-
-    query_result = wikidata2df(query)
+    resolved = resolve_identifiers(
+        list_of_dois,
+        kind="doi",
+        chunk_size=chunk_size,
+        max_workers=max_workers,
+        endpoint=endpoint,
+        cache=cache,
+        client=client,
+        index=index,
+    )
 
     result = {}
+    result["qids"] = set().union(*resolved["qids"].values())
+    result["missing"] = resolved["missing"] | resolved["unrecognized"]
+    return result
 
-    result["qids"] = list(query_result["item"].values)
-    result["missing"] = []
 
-    for doi in list_of_dois:
-        if doi.upper() not in list(query_result["id"].values):
-            result["missing"].append(doi)
+def convert_doi_stream(
+    source,
+    qids_out,
+    missing_out,
+    format=None,
+    chunk_size=DOI_CHUNK_SIZE,
+    max_workers=DOI_MAX_WORKERS,
+    endpoint=sparql.WDQS_ENDPOINT,
+    cache=None,
+    client=None,
+    window=dois.DEDUPLICATION_WINDOW,
+    index=None,
+):
+    """
+    Converts the DOIs of a possibly very large file to Wikidata QIDs, writing the
+    results as they arrive.
 
-    result["qids"] = set(result["qids"])
-    result["missing"] = set(result["missing"])
-    return result
+    DOIs are read lazily (see `wbib.dois.read_dois`), normalized, de-duplicated
+    within a bounded window (see `wbib.dois.deduplicate`) and resolved a few chunks
+    at a time. After each batch of chunks, the matches are written to `qids_out`
+    as "DOI<tab>QID" lines, the misses to `missing_out` as one DOI per line, and
+    both are flushed, so that a crash loses at most the batch in flight.
+
+    Args:
+      source: The path to a file, optionally gzipped, or an iterable of lines.
+      qids_out: A text file-like object for the matches.
+      missing_out: A text file-like object for the DOIs not found.
+      format (str): The format of `source`, such as "bibtex" or "ris".
+        Defaults to a guess from the file name.
+      chunk_size (int): The maximum number of DOIs sent in a single query.
+      max_workers (int): The maximum number of queries running concurrently.
+      endpoint (str): The URL of the SPARQL endpoint. Defaults to the public WDQS.
+      cache (wbib.cache.SPARQLCache): An optional cache for the query results.
+      client (wbib.sparql.AsyncSPARQLClient): An optional client to run the queries with.
+        When given, `max_workers`, `endpoint` and `cache` are taken from the client instead.
+      window (int): The number of distinct DOIs remembered for de-duplication.
+      index (wbib.index.IdentifierIndex): An optional offline index built with DOIs,
+        used instead of the endpoint.
+
+    Returns:
+      dict: The number of "dois" resolved, of DOIs "found" and of DOIs "missing".
+    """
+
+    if chunk_size < 1:
+        raise ValueError("'chunk_size' needs to be a positive integer")
+
+    counts = {"dois": 0, "found": 0, "missing": 0}
+    unique_dois = dois.deduplicate(dois.read_dois(source, format), window)
+    chunks = dois.chunked(unique_dois, chunk_size)
+
+    def resolve(client):
+        batch_size = client.max_concurrency
+        for batch in dois.chunked(chunks, batch_size):
+            lookups = [("doi", {doi: [doi] for doi in chunk}) for chunk in batch]
+            for (_, by_value), pairs in _resolve_chunks(lookups, client, index):
+                chunk = list(by_value)
+                found = set()
+                for doi, qid in pairs:
+                    qids_out.write("{}\t{}\n".format(doi, qid))
+                    found.add(doi)
+                for doi in chunk:
+                    if doi not in found:
+                        missing_out.write(doi + "\n")
+                counts["dois"] += len(chunk)
+                counts["found"] += len(found)
+                counts["missing"] += len(chunk) - len(found)
+            for out in (qids_out, missing_out):
+                if hasattr(out, "flush"):
+                    out.flush()
+
+    with instrumentation.span("resolve_dois", chunk_size=chunk_size) as attributes:
+        if client is None:
+            with sparql.AsyncSPARQLClient(
+                endpoint=endpoint, max_concurrency=max_workers, cache=cache
+            ) as own_client:
+                resolve(own_client)
+        else:
+            resolve(client)
+        if attributes is not None:
+            attributes["dois"] = counts["dois"]
+            attributes["qids"] = counts["found"]
+    return counts